@@ -0,0 +1,217 @@
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import subprocess
+from statistics import median
+from bus import Bus
+from chip import *
+from console import Console
+from cpu import Engine
+from cpu_bench import nestest_cpu, nestest_cycles
+from movie import load, play
+from nes import Nes
+from ppu import decode_tiles
+from ppu_bench import mario_ppu
+
+
+NESTEST_INSTRUCTIONS = 8990
+BUS_ACCESSES = 1 << 16
+
+
+def measure(func, repeat, warmup, setup=None):
+    '''
+    (best, median) seconds of func(), called `warmup` times first and then
+    `repeat` times. setup() runs untimed before every call and its result
+    is passed to func
+    '''
+    times = []
+    for i in range(warmup + repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed)
+    return min(times), median(times)
+
+
+def rate(name, count, unit, times):
+    '''
+    result of `count` things per timed call
+    '''
+    best, mid = times
+    return name, {'value': count / best, 'unit': unit, 'best_s': best, 'median_s': mid}
+
+
+def duration(name, times):
+    best, mid = times
+    return name, {'value': best * 1e6, 'unit': 'us', 'best_s': best, 'median_s': mid}
+
+
+def bench_cpu(repeat, warmup):
+    nes = Nes()
+    nes.load('roms/nestest.nes', False)
+    cycles = nestest_cycles(nes, NESTEST_INSTRUCTIONS)
+
+    def run(cpu):
+        # blocks only run from run_cycles
+        cpu.run_cycles(cycles - cpu.cycle())
+    for engine in Engine:
+        times = measure(run, repeat, warmup, lambda: nestest_cpu(nes, engine, False))
+        yield rate('cpu.nestest.' + engine.name, NESTEST_INSTRUCTIONS, 'ins/s', times)
+
+
+def cpu_bus():
+    nes = Nes()
+    nes.load('roms/mario.nes', False)
+    pgr = PGRRom()
+    pgr.load(nes.pgr)
+    bus = Bus()
+    bus.connect(pgr)
+    bus.connect(Ram())
+    bus.connect(PAuExp())
+    return bus
+
+
+def bench_bus(repeat, warmup):
+    bus = cpu_bus()
+    # ram, $4000-$5FFF and prg in turn
+    reads = [(0x0000, 0x4000, 0x8000)[i % 3] + i % 0x800 for i in range(BUS_ACCESSES)]
+    writes = [addr for addr in reads if addr < 0x8000]
+
+    def read(_):
+        bus_read = bus.read
+        for addr in reads:
+            bus_read(addr)
+
+    def write(_):
+        bus_write = bus.write
+        for addr in writes:
+            bus_write(addr, addr & 0xFF)
+    yield rate('bus.read', len(reads), 'reads/s', measure(read, repeat, warmup))
+    yield rate('bus.write', len(writes), 'writes/s', measure(write, repeat, warmup))
+
+
+def bench_ppu(repeat, warmup):
+    ppu = mario_ppu()
+    nes = Nes()
+    nes.load('roms/mario.nes', False)
+    chr_data = bytes(nes.chr)
+
+    def background(_):
+        ppu.background_indices(0)
+    yield rate('ppu.background', 1, 'renders/s', measure(background, repeat * 10, warmup))
+    yield duration('ppu.pattern_decode', measure(lambda _: decode_tiles(chr_data), repeat * 10, warmup))
+
+
+def roms():
+    return sorted(glob.glob('roms/*.nes'))
+
+
+def bench_load(repeat, warmup):
+    for path in roms():
+        yield duration('nes.load.' + path, measure(lambda _: Nes().load(path, False), repeat, warmup))
+
+
+def bench_frames(repeat, warmup, frames):
+    def run(console):
+        for _ in range(frames):
+            console.run_frame()
+    for path in roms():
+        try:
+            Console(path)
+        except AssertionError:
+            continue
+        times = measure(run, repeat, warmup, lambda: Console(path))
+        yield rate('frames.' + path, frames, 'fps', times)
+
+
+def bench_movies(repeat, warmup):
+    '''
+    movies/<rom>.movie replayed on roms/<rom>.nes, checking every frame.
+    The movies must get into the game: there is none of mario, which waits
+    for a sprite 0 hit this PPU never sets and ignores its input
+    '''
+    for path in sorted(glob.glob('movies/*.movie')):
+        rom = os.path.join('roms', os.path.splitext(os.path.basename(path))[0] + '.nes')
+        movie = load(path)
+
+        def run(console):
+            frame = play(console, movie)
+            assert frame is None, '{} diverged at frame {}'.format(path, frame)
+        times = measure(run, repeat, warmup, lambda: Console(rom))
+        yield rate('movie.' + path, len(movie), 'fps', times)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(repeat, warmup, frames):
+    results = {}
+    suites = [
+        bench_cpu(repeat, warmup),
+        bench_bus(repeat, warmup),
+        bench_ppu(repeat, warmup),
+        bench_load(repeat, warmup),
+        bench_frames(repeat, warmup, frames),
+        bench_movies(repeat, warmup),
+    ]
+    for suite in suites:
+        for name, result in suite:
+            results[name] = result
+            print('{:<34} {:14.1f} {}'.format(name, result['value'], result['unit']))
+    return {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'repeat': repeat,
+        'warmup': warmup,
+        'frames': frames,
+        'results': results,
+    }
+
+
+def compare(old, new):
+    '''
+    print new / old of every result in both with the same unit, > 1 is
+    better
+    '''
+    for name, result in new['results'].items():
+        if name not in old['results'] or old['results'][name]['unit'] != result['unit']:
+            continue
+        before = old['results'][name]['value']
+        after = result['value']
+        # durations are better when lower
+        ratio = before / after if result['unit'] == 'us' else after / before
+        print('{:<34} {:14.1f} -> {:14.1f} {:<10} x{:.2f}'.format(name, before, after, result['unit'], ratio))
+
+
+def main():
+    '''
+    python bench.py [out.json] [repeat] [warmup] [frames]
+    python bench.py compare old.json new.json
+    '''
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as a, open(sys.argv[3]) as b:
+            compare(json.load(a), json.load(b))
+        return
+    out = sys.argv[1] if len(sys.argv) > 1 else None
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    warmup = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    frames = int(sys.argv[4]) if len(sys.argv) > 4 else 300
+    report = run_all(repeat, warmup, frames)
+    if out is not None:
+        with open(out, 'w') as fout:
+            json.dump(report, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import re
+from dispatch import (
+    ZERO_MODES, CONTROL, REGISTERS, template, expand, zero_page, bus_calls,
+    read_first, assigned
+)
+from tracer import TRACE, CPU_RTI
+
+
+# Basic blocks: straight runs of PRG-ROM code up to the first instruction
+# which sets pc itself, compiled to one python function each. Operands and
+# ROM data are constants, registers are locals, flags nobody reads before
+# they are set again are not computed and cycles are summed at compile time.
+
+# longest block, in instructions
+MAX_INSTRUCTIONS = 32
+# a block is compiled on its HOT_VISITS-th entry, code running once or
+# twice is not worth compiling
+HOT_VISITS = 8
+
+ALL_FLAGS = frozenset('NVDIZC')
+
+_SET_FLAGS = re.compile(r'^\s*set_(nz|n|v|d|i|z|c)\(.*\)$')
+_READ_FLAGS = re.compile(r'\$([A-Z])')
+_PC_STEP = re.compile(r'^pc = pc \+ \d$')
+_WRITE_ADDR = re.compile(r'^(\s*)write\(addr, (.*)\)$')
+
+
+class Block:
+
+    __slots__ = ('run', 'start', 'last', 'max_cycles', 'source', 'runs')
+
+    def __init__(self, run, start, last, max_cycles, source):
+        # run(now) executes the block and returns the cycles it took; a
+        # guarded block is run() and counts its runs, see compile_block
+        self.run = run
+        self.start = start
+        # pc of the last instruction
+        self.last = last
+        # upper bound of the cycles taken, with every page cross penalty
+        self.max_cycles = max_cycles
+        self.source = source
+        self.runs = 0
+
+
+def _flags_read(line):
+    names = set(_READ_FLAGS.findall(line))
+    if 'P' in names:
+        return ALL_FLAGS
+    return frozenset(names)
+
+
+def _drop_dead_flags(instructions):
+    '''
+    remove set_x() lines whose flags are set again before being read; all
+    flags are live at the end of the block
+    '''
+    live = ALL_FLAGS
+    for lines in reversed(instructions):
+        kept = []
+        for line in reversed(lines):
+            match = _SET_FLAGS.match(line)
+            if match:
+                written = frozenset(match.group(1).upper())
+                if not written & live:
+                    continue
+                live = live - written
+            elif 'set_p(' in line:
+                live = frozenset()
+            live = live | _flags_read(line)
+            kept.append(line)
+        lines[:] = reversed(kept)
+
+
+def _const_access(line, addr, prg, mask, rom_start):
+    '''
+    accesses of a known address: RAM indexed directly, ROM bytes folded
+    into constants, anything else through its page handler
+    '''
+    if addr < 0x2000:
+        read = 'RAM[0x{:03X}]'.format(addr & 0x7FF)
+    elif addr >= rom_start:
+        read = '0x{:02X}'.format(prg[addr & mask])
+    else:
+        read = 'RD[0x{:02X}](0x{:04X})'.format(addr >> 8, addr)
+    line = line.replace('read(addr)', read)
+    match = _WRITE_ADDR.match(line)
+    if match:
+        indent, value = match.groups()
+        if addr < 0x2000:
+            return '{}RAM[0x{:03X}] = {}'.format(indent, addr & 0x7FF, value)
+        return '{}WR[0x{:02X}](0x{:04X}, {})'.format(indent, addr >> 8, addr, value)
+    return line
+
+
+def _is_io(addr, rom_start):
+    return addr is None or 0x2000 <= addr < rom_start
+
+
+def block_source(cpu, start, count=MAX_INSTRUCTIONS, guarded=False):
+    '''
+    (source, name, last pc, max cycles) of the block starting at `start`,
+    at most `count` instructions long, or None if its first instruction is
+    not supported
+    '''
+    ram, prg, mask = cpu.direct_memory()
+    rom_start = cpu._rom_start
+    decoded = []
+    pc = start
+    while len(decoded) < count and pc + 3 <= 0x10000:
+        ins = cpu._ins[prg[pc & mask]]
+        res = template(ins)
+        if res is None:
+            break
+        decoded.append((pc, ins, res))
+        pc += ins.length()
+        if ins.name() in CONTROL:
+            break
+    if not decoded:
+        return None
+    end = pc
+
+    templates = [[line for line in lines if not _PC_STEP.match(line)] for _, _, (lines, _) in decoded]
+    _drop_dead_flags(templates)
+
+    body = []
+    static = 0
+    crosses = 0
+    dynamic = False
+    branch = False
+    for (pc, ins, (_, cycles)), lines in zip(decoded, templates):
+        mode = ins.addr_mode().name
+        operand = [prg[(pc + i) & mask] for i in range(ins.length())]
+        if mode == 'Absolute':
+            addr = operand[1] | (operand[2] << 8)
+        elif mode == 'ZeroPage':
+            addr = operand[1]
+        else:
+            addr = None
+        if ins.name() in CONTROL:
+            body.append('pc = 0x{:04X}'.format(pc))
+        accesses = any('read(addr)' in line or 'write(addr' in line or 'read(ptr)' in line for line in lines)
+        traced = any('TRACE.emit' in line for line in lines)
+        if traced or accesses and mode not in ZERO_MODES and _is_io(addr, rom_start):
+            # the PPU syncs and the tracer stamps events with the cycle the
+            # instruction started at
+            now = 'now + {}'.format(static)
+            if dynamic:
+                now += ' + extra'
+            body.append('C._now_cycle = {}'.format(now))
+        fetch = lambda index: '0x{:02X}'.format(operand[index])
+        for line in lines:
+            for l in expand(line, mode, fetch):
+                if addr is not None:
+                    l = _const_access(l, addr, prg, mask, rom_start)
+                body.append(bus_calls(zero_page(l, mode), True))
+        if cycles == 'cycles':
+            branch = True
+        elif cycles.isdigit():
+            static += int(cycles)
+        else:
+            base, cross = cycles.split(' + ', 1)
+            static += int(base)
+            crosses += 1
+            dynamic = True
+            body.append('extra += {}'.format(cross))
+
+    last, last_ins, _ = decoded[-1]
+    if last_ins.name() not in CONTROL:
+        body.append('pc = 0x{:04X}'.format(end))
+    total = str(static)
+    if dynamic:
+        total += ' + extra'
+    if branch:
+        total += ' + cycles'
+    head = []
+    tail = ['S.pc = pc']
+    for reg in REGISTERS:
+        if read_first(body, reg):
+            head.append('{0} = S.{0}'.format(reg))
+        if assigned(body, reg):
+            tail.append('S.{0} = {0}'.format(reg))
+    if dynamic:
+        head.append('extra = 0')
+    name = 'block_{:04X}'.format(start)
+    max_cycles = static + crosses + (4 if branch else 0)
+    if guarded:
+        lines = [
+            'def {}():'.format(name),
+            '    now = C._now_cycle',
+            '    if now + {} >= C._limit:'.format(max_cycles),
+            '        return H()',
+            '    B.runs += 1',
+        ]
+    else:
+        lines = ['def {}(now):'.format(name)]
+    lines.extend('    ' + line for line in head + body + tail)
+    lines.append('    return {}'.format(total))
+    return '\n'.join(lines), name, last, max_cycles
+
+
+def compile_block(cpu, start, count=MAX_INSTRUCTIONS, fallback=None):
+    '''
+    Block for the code at `start`, None if it cannot be compiled. Needs the
+    CPU to see RAM and PRG directly.
+    with a `fallback` handler the block is guarded: it takes the place of a
+    handler, starts at C._now_cycle and runs only if it surely ends before
+    C._limit, else it runs fallback() for the first instruction alone
+    '''
+    res = block_source(cpu, start, count, fallback is not None)
+    if res is None:
+        return None
+    source, name, last, max_cycles = res
+    ram, prg, _ = cpu.direct_memory()
+    block = Block(None, start, last, max_cycles, source)
+    namespace = {
+        'RD': cpu._bus.read_page,
+        'WR': cpu._bus.write_page,
+        'S': cpu._s,
+        'C': cpu,
+        'RAM': ram,
+        'PRG': prg,
+        'H': fallback,
+        'B': block,
+        'TRACE': TRACE,
+        'CPU_RTI': CPU_RTI,
+    }
+    exec(compile(source, '<block ${:04X}>'.format(start), 'exec'), namespace)
+    block.run = namespace[name]
+    return block
@@ -1,28 +1,77 @@
 from chip import Chip
 
 
+PAGES = 256
+PAGE_SIZE = 256
+
+
 class Bus:
 
     def __init__(self):
         self.chips = []
+        # chips answering somewhere in each 256-byte page: [(chip, whole_page)]
+        self._page_chips = [[] for _ in range(PAGES)]
+        # one read / write function per page, indexed by addr >> 8
+        self.read_page = [None] * PAGES
+        self.write_page = [None] * PAGES
+        for page in range(PAGES):
+            self._update(page)
 
     def connect(self, chip: Chip):
         self.chips.append(chip)
+        for page in range(PAGES):
+            base = page * PAGE_SIZE
+            hits = 0
+            for addr in range(base, base + PAGE_SIZE):
+                if chip.sensitive(addr):
+                    hits += 1
+            if hits > 0:
+                self._page_chips[page].append((chip, hits == PAGE_SIZE))
+                self._update(page)
+
+    def owner(self, addr):
+        '''
+        the chip decoding the whole page of addr on its own, or None
+        '''
+        chips = self._page_chips[addr >> 8]
+        if chips and chips[0][1] and not chips[0][0].fine_grained:
+            return chips[0][0]
+        return None
+
+    def _update(self, page):
+        chips = self._page_chips[page]
+        if not chips:
+            self.read_page[page] = self._unmapped_read
+            self.write_page[page] = self._unmapped_write
+        elif chips[0][1] and not chips[0][0].fine_grained:
+            # the first chip owns the whole page, as in a linear scan
+            self.read_page[page] = chips[0][0].read
+            self.write_page[page] = chips[0][0].write
+        else:
+            self.read_page[page], self.write_page[page] = self._decoder([c for c, _ in chips])
+
+    def _decoder(self, chips):
+        def read(addr):
+            for chip in chips:
+                if chip.sensitive(addr):
+                    return chip.read(addr)
+            return self._unmapped_read(addr)
+
+        def write(addr, value):
+            for chip in chips:
+                if chip.sensitive(addr):
+                    return chip.write(addr, value)
+            return self._unmapped_write(addr, value)
+        return read, write
+
+    def _unmapped_read(self, addr):
+        assert False, 'ADDR: {}'.format(addr)
+
+    def _unmapped_write(self, addr, value):
+        assert False, 'ADDR: {}'.format(addr)
 
     def read(self, addr):
-        read_chip = None
-        for chip in self.chips:
-            if chip.sensitive(addr):
-                read_chip = chip
-                break
-        assert read_chip is not None, 'ADDR: {}'.format(addr)
-        return read_chip.read(addr)
+        return self.read_page[addr >> 8](addr)
 
     def write(self, addr, value):
-        write_chip = None
-        for chip in self.chips:
-            if chip.sensitive(addr):
-                write_chip = chip
-                break
-        assert write_chip is not None
-        return write_chip.write(addr, value)
\ No newline at end of file
+        return self.write_page[addr >> 8](addr, value)
@@ -1,6 +1,13 @@
 
+from tracer import TRACE, PPU_CTRL, NAMETABLE_ATTR
+
+
 class Chip:
 
+    # set to True when the bus must call sensitive() on every access instead
+    # of mapping whole 256-byte pages to this chip
+    fine_grained = False
+
     def __init__(self):
         pass
 
@@ -18,18 +25,20 @@ class Ram(Chip):
 
     def __init__(self):
         super().__init__()
-        self._mem = [0] * 0x800
+        self._mem = bytearray(0x800)
 
     def sensitive(self, addr):
         return 0x0000 <= addr < 0x2000
 
+    def memory(self):
+        return self._mem
+
     def read(self, addr):
-        return self._mem[addr % 0x800]
+        return self._mem[addr & 0x7FF]
 
     def write(self, addr, value):
-        assert isinstance(value, int)
-        assert 0 <= value < 256
-        self._mem[addr % 0x800] = value
+        # bytearray rejects anything outside [0, 256)
+        self._mem[addr & 0x7FF] = value
         return True
 
 
@@ -46,11 +55,35 @@ class PPURegister(Chip):
         self._ppu_bus = ppu_bus
 
         self._debug_cnt = 0
+        self._sync = lambda: None
+
+    def set_sync(self, func):
+        '''
+        func() is called before every access to bring the ppu up to date
+        '''
+        self._sync = func
 
     def sensitive(self, addr):
         return 0x2000 <= addr < 0x4000
 
+    def poll_state(self):
+        '''
+        everything a read of STATUS depends on or changes
+        '''
+        return self._mem[2], self._cpu_write_half_addr
+
+    def state(self):
+        '''
+        (registers, read buffer, vram address, second write) for a save state
+        '''
+        return bytes(self._mem), self._buffered_data, self._ppu_addr, self._cpu_write_half_addr
+
+    def set_state(self, state):
+        mem, self._buffered_data, self._ppu_addr, self._cpu_write_half_addr = state
+        self._mem[:] = mem
+
     def read(self, addr):
+        self._sync()
         res = self._mem[(addr - 0x2000) % 8]
         addr = (addr - 0x2000) % 8
         if addr == 2:
@@ -76,13 +109,15 @@ class PPURegister(Chip):
     def write(self, addr, value):
         assert isinstance(value, int)
         assert 0 <= value < 256
+        self._sync()
         
         self._mem[(addr - 0x2000) % 8] = value
         # print('Cpu Write: {:04X} = {}'.format(addr, value))
         # input('waiting...')
         addr = (addr - 0x2000) % 8
         if addr == 0: # CTRL
-            print('Cpu Write: CTRL = {}'.format(value))
+            if TRACE.mask & PPU_CTRL:
+                TRACE.emit(PPU_CTRL, value)
         elif addr == 1: # MASK
             pass
         elif addr == 2: # STATUS
@@ -195,39 +230,99 @@ class PAuExp(Chip):
 
     def __init__(self):
         super().__init__()
-        self._mem = [0] * 0x2000
+        self._mem = bytearray(0x2000)
 
     def sensitive(self, addr):
         return 0x4000 <= addr < 0x6000
 
+    def memory(self):
+        return self._mem
+
     def read(self, addr):
         return self._mem[addr - 0x4000]
 
     def write(self, addr, value):
-        assert isinstance(value, int)
-        assert 0 <= value < 256
         self._mem[addr - 0x4000] = value
         return True
 
 
+# controller buttons, in the order they are read out
+BUTTON_A = 1 << 0
+BUTTON_B = 1 << 1
+BUTTON_SELECT = 1 << 2
+BUTTON_START = 1 << 3
+BUTTON_UP = 1 << 4
+BUTTON_DOWN = 1 << 5
+BUTTON_LEFT = 1 << 6
+BUTTON_RIGHT = 1 << 7
+
+
+class Controller(Chip):
+    '''
+    two standard controllers, read one button at a time from $4016 and
+    $4017. buttons[port] is the BUTTON_ bits held down; writing 1 then 0
+    to $4016 latches them. Writes to $4017 (the APU frame counter) are
+    ignored
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.buttons = [0, 0]
+        self._shift = [0, 0]
+        self._strobe = False
+
+    def sensitive(self, addr):
+        return 0x4016 <= addr < 0x4018
+
+    def state(self):
+        '''
+        (shift register 1, shift register 2, strobe) for a save state
+        '''
+        return self._shift[0], self._shift[1], self._strobe
+
+    def set_state(self, state):
+        self._shift[0], self._shift[1], self._strobe = state
+
+    def read(self, addr):
+        port = addr - 0x4016
+        if self._strobe:
+            return 0x40 | (self.buttons[port] & 1)
+        shift = self._shift[port]
+        # after the 8 buttons an official controller reads 1
+        self._shift[port] = (shift >> 1) | 0x80
+        return 0x40 | (shift & 1)
+
+    def write(self, addr, value):
+        if addr == 0x4016:
+            self._strobe = bool(value & 1)
+            self._shift[0], self._shift[1] = self.buttons
+        return True
+
+
 class PGRRom(Chip):
 
     def __init__(self):
         super().__init__()
-        self._mem = [0] * 0x4000 * 2
+        self._mem = memoryview(bytes(0x4000 * 2))
+        # NROM-128 mirrors its 16 KB at $C000 by masking the address
+        self._mask = 0x7FFF
 
     def sensitive(self, addr):
         return 0x8000 <= addr < 0x8000 + 0x4000 * 2
 
     def load(self, content):
-        for i, v in enumerate(content):
-            self._mem[i] = v
-        if len(content) == 0x4000:
-            for i, v in enumerate(content):
-                self._mem[i + 0x4000] = v
+        assert len(content) in (0x4000, 0x4000 * 2), 'Unsupported PRG size: {}'.format(len(content))
+        self._mem = memoryview(content)
+        self._mask = len(content) - 1
+
+    def window(self):
+        '''
+        (buffer, mask): the byte at $8000-$FFFF is buffer[addr & mask]
+        '''
+        return self._mem, self._mask
 
     def read(self, addr):
-        return self._mem[addr - 0x8000]
+        return self._mem[addr & self._mask]
 
     def write(self, addr, value):
         return False
@@ -237,41 +332,69 @@ class PatternTable(Chip):
 
     def __init__(self):
         super().__init__()
-        self._mem = [0] * 0x2000
+        self._mem = memoryview(bytes(0x2000))
+        self._writable = False
+        self._on_change = lambda start, end: None
 
     def sensitive(self, addr):
         return 0 <= addr < 0x2000
 
+    def memory(self):
+        return self._mem
+
+    def writable(self):
+        '''
+        True for CHR RAM
+        '''
+        return self._writable
+
+    def set_on_change(self, func):
+        '''
+        func(start, end) is called after bytes [start, end) change
+        '''
+        self._on_change = func
+
     def read(self, addr):
         return self._mem[addr]
 
     def write(self, addr, value):
-        assert False, "Cannot write PGR ROM"
-        return False
+        assert self._writable, "Cannot write CHR ROM"
+        self._mem[addr] = value
+        self._on_change(addr, addr + 1)
+        return True
 
     def load(self, content):
-        assert len(content) == 0x2000
-        for i, v in enumerate(content):
-            self._mem[i] = v
+        '''
+        an empty `content` means the cartridge has 8 KB of CHR RAM instead
+        '''
+        if len(content) == 0:
+            self._mem = bytearray(0x2000)
+            self._writable = True
+        else:
+            assert len(content) == 0x2000
+            self._mem = memoryview(content)
+            self._writable = False
+        self._on_change(0, 0x2000)
 
 
 class NameTable(Chip):
 
     def __init__(self):
         super().__init__()
-        self._mem = [0] * (0x3F00 - 0x2000)
+        self._mem = bytearray(0x3F00 - 0x2000)
 
     def sensitive(self, addr):
         return 0x2000 <= addr < 0x3F00
 
+    def memory(self):
+        return self._mem
+
     def read(self, addr):
         return self._mem[addr - 0x2000]
 
     def write(self, addr, value):
-        assert isinstance(value, int)
-        assert 0 <= value < 256
-        if 0x2000 + 960 <= addr <= 0x2000 + 1024:
-            print('NameTable Write: ${:04X} = {}'.format(addr, value))
+        if TRACE.mask & NAMETABLE_ATTR and 0x2000 + 960 <= addr <= 0x2000 + 1024:
+            TRACE.emit(NAMETABLE_ATTR, addr, value)
         self._mem[addr - 0x2000] = value
         return True
 
@@ -280,11 +403,14 @@ class PaletteTable(Chip):
 
     def __init__(self):
         super().__init__()
-        self._mem = [0] * 0x20
+        self._mem = bytearray(0x20)
 
     def sensitive(self, addr):
         return 0x3F00 <= addr < 0x4000
 
+    def memory(self):
+        return self._mem
+
     def read(self, addr):
         # print(self._mem[:16])
         addr = (addr - 0x3F00) % 0x20
@@ -301,8 +427,6 @@ class PaletteTable(Chip):
         return self._mem[addr]
 
     def write(self, addr, value):
-        assert isinstance(value, int)
-        assert 0 <= value < 256
         addr = (addr - 0x3F00) % 0x20
         if addr == 0x10:
             addr = 0x00
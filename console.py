@@ -0,0 +1,147 @@
+import sys
+import time
+import zlib
+from bus import Bus
+from chip import *
+from cpu import Cpu6502, Engine
+from nes import Nes
+from ppu import Ppu, to_rgb
+from scheduler import NTSC_FPS
+
+
+# only NROM cartridges, PRG and CHR are mapped as they are
+SUPPORTED_MAPPERS = {0}
+
+
+class Console:
+    '''
+    cpu, ppu, buses and cartridge wired together, without any frontend.
+    frame() is the screen as an array of nes colors
+    '''
+
+    def __init__(self, path, engine=Engine.Dispatch, verbose=False):
+        nes = Nes()
+        nes.load(path, verbose)
+        assert nes.mapper() in SUPPORTED_MAPPERS, 'Unsupported mapper: {}'.format(nes.mapper())
+        self._nes = nes
+
+        # configure ppu
+        self._ppu_bus = Bus()
+        self._ppu_pattern = PatternTable()
+        self._ppu_pattern.load(nes.chr)
+        self._ppu_name = NameTable()
+        self._ppu_palette = PaletteTable()
+        self._ppu_bus.connect(self._ppu_pattern)
+        self._ppu_bus.connect(self._ppu_name)
+        self._ppu_bus.connect(self._ppu_palette)
+        self._ppu = Ppu(self._ppu_bus)
+
+        # configure cpu
+        self._cpu_ram = Ram()
+        self._pgr = PGRRom()
+        self._pgr.load(nes.pgr)
+        self._papu_ram = PAuExp()
+        self._controller = Controller()
+        self._cpu_bus = Bus()
+        self._cpu_bus.connect(self._pgr)
+        self._cpu_bus.connect(self._cpu_ram)
+        # before PAuExp, which would answer $4016 and $4017 too
+        self._cpu_bus.connect(self._controller)
+        self._cpu_bus.connect(self._papu_ram)
+        self._cpu_bus.connect(self._ppu.get_register())
+        self._cpu = Cpu6502(self._cpu_bus, engine)
+        self._cpu.reset()
+
+        self._ppu.set_request_nmi(self._cpu.request_nmi)
+        self._ppu.set_notify_vblank(self._cpu.end_frame)
+        self._ppu.set_clock(self._cpu.cycle)
+        self._cpu.set_sync(self._ppu.sync)
+        self.frames = 0
+        self._rom_crc = zlib.crc32(nes.pgr)
+
+    def get_cpu(self):
+        return self._cpu
+
+    def get_ppu(self):
+        return self._ppu
+
+    def get_nes(self):
+        return self._nes
+
+    def get_controller(self):
+        return self._controller
+
+    def rom_crc(self):
+        '''
+        crc32 of the PRG, save states are only restored into the same rom
+        '''
+        return self._rom_crc
+
+    def memories(self):
+        '''
+        every writable memory in save state order: cpu ram, $4000-$5FFF,
+        nametables, palette and the CHR RAM if the cartridge has one
+        '''
+        res = [self._cpu_ram.memory(), self._papu_ram.memory(),
+               self._ppu_name.memory(), self._ppu_palette.memory()]
+        if self._ppu_pattern.writable():
+            res.append(self._ppu_pattern.memory())
+        return res
+
+    def reset(self):
+        self._cpu.reset()
+        self.frames = 0
+
+    def run_cycles(self, budget):
+        '''
+        returns (cycles used, StopReason)
+        '''
+        return self._cpu.run_cycles(budget)
+
+    def run_frame(self):
+        '''
+        run until the next vblank, returns the cycles used
+        '''
+        cycles, _ = self._cpu.run_frame()
+        self.frames += 1
+        return cycles
+
+    def frame(self):
+        '''
+        (240, 256) uint8 array of nes colors: the nametable selected by CTRL,
+        without scrolling or sprites
+        '''
+        return self._ppu.background_indices(self._ppu.get_register().ctrl & 3)
+
+    def frame_rgb(self):
+        '''
+        the frame as 256 * 240 * 3 bytes of rgb
+        '''
+        return to_rgb(self.frame()).tobytes()
+
+
+def main():
+    '''
+    python console.py rom [frames] [Interpreter|Dispatch] [render_every]
+
+    runs as fast as possible; with render_every > 0 the rgb frame is built
+    every render_every frames, as a frontend would
+    '''
+    path = sys.argv[1]
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    engine = Engine[sys.argv[3]] if len(sys.argv) > 3 else Engine.Dispatch
+    render_every = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    console = Console(path, engine)
+    start = time.perf_counter()
+    for i in range(1, frames + 1):
+        console.run_frame()
+        if render_every and i % render_every == 0:
+            console.frame_rgb()
+    elapsed = time.perf_counter() - start
+    fps = frames / elapsed
+    print('{}: {} frames in {:.2f}s, {:.1f} fps, x{:.2f} real time'.format(
+        path, frames, elapsed, fps, fps / NTSC_FPS))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 from enum import Enum
 from bus import Bus
+from chip import Ram, PGRRom, PPURegister
+from dispatch import build_handlers
+from block import HOT_VISITS, compile_block
+from fusion import HOT_LOOP, HOT_FUSION, Fusion, find_fusions
+from idle import analyse
+from tracer import TRACE, CPU_NMI, CPU_RTI
 from util import u8, u16, s8
 
 
@@ -22,6 +28,20 @@ AddrMode = Enum('AddrMode', [
 ])
 
 
+Engine = Enum('Engine', [
+    'Interpreter',              # decode through the Instruction table
+    'Dispatch',                 # precompiled handler per opcode
+    'Block'                     # Dispatch plus compiled basic blocks in ROM
+])
+
+
+StopReason = Enum('StopReason', [
+    'Budget',                   # the cycle budget is used up
+    'Nmi',                      # vblank started and an NMI is pending
+    'VBlank'                    # vblank started, NMIs disabled
+])
+
+
 class Instruction:
 
     def __init__(self, name: str, mode: AddrMode, cycle: int, func):
@@ -138,145 +158,69 @@ class Instruction:
         return res
 
 
-class Flag:
-
-    def __init__(self):
-        self._n = False # 7
-        self._v = False # 6
-        # bit 5 is not used, always True
-        self._b = False # 4
-        self._d = False # 3
-        self._i = False # 2
-        self._z = False # 1
-        self._c = False # 0
-
-    def set(self, value: int):
-        self.n = (value >> 7 & 1) == 1
-        self.v = (value >> 6 & 1) == 1
-        self.b = (value >> 4 & 1) == 1
-        self.d = (value >> 3 & 1) == 1
-        self.i = (value >> 2 & 1) == 1
-        self.z = (value >> 1 & 1) == 1
-        self.c = (value >> 0 & 1) == 1
-
-    def get(self):
-        res = 1 << 5
-        if self.n:
-            res |= (1 << 7)
-        if self.v:
-            res |= (1 << 6)
-        if self.b:
-            res |= (1 << 4)
-        if self.d:
-            res |= (1 << 3)
-        if self.i:
-            res |= (1 << 2)
-        if self.z:
-            res |= (1 << 1)
-        if self.c:
-            res |= (1 << 0)
-        return res
-
-    @property
-    def n(self):
-        return self._n
-
-    @n.setter
-    def n(self, v):
-        assert isinstance(v, bool)
-        self._n = v
-    
-    @property
-    def v(self):
-        return self._v
-
-    @v.setter
-    def v(self, v):
-        assert isinstance(v, bool)
-        self._v = v
-
-    @property
-    def b(self):
-        return self._b
-
-    @b.setter
-    def b(self, v):
-        assert isinstance(v, bool)
-        self._b = v
-
-    
-    @property
-    def d(self):
-        return self._d
-
-    @d.setter
-    def d(self, v):
-        assert isinstance(v, bool)
-        self._d = v
-
-    @property
-    def i(self):
-        return self._i
-
-    @i.setter
-    def i(self, v):
-        assert isinstance(v, bool)
-        self._i = v
+# deadline used when no ppu is attached
+_NEVER = 1 << 62
 
-    @property
-    def z(self):
-        return self._z
 
-    @z.setter
-    def z(self, v):
-        assert isinstance(v, bool)
-        self._z = v
+FLAG_N = 1 << 7
+FLAG_V = 1 << 6
+# bit 5 is not used, always set
+FLAG_B = 1 << 4
+FLAG_D = 1 << 3
+FLAG_I = 1 << 2
+FLAG_Z = 1 << 1
+FLAG_C = 1 << 0
 
-    @property
-    def c(self):
-        return self._c
 
-    @c.setter
-    def c(self, v):
-        assert isinstance(v, bool)
-        self._c = v
+class CpuState:
+    '''
+    N and Z are lazy: `nz` is the last result they were set from, Z when its
+    low byte is 0, N when bit 7 or 8 is set (0x100 is N and Z together). The
+    N and Z bits of `p` are stale, Cpu6502.flags() gives the real P
+    '''
 
-
-class Register8:
+    __slots__ = ('a', 'x', 'y', 'sp', 'pc', 'p', 'nz')
 
     def __init__(self):
-        self._value = 0
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0
+        self.pc = 0
+        self.p = 1 << 5
+        self.nz = 1
+
 
-    @property
-    def value(self):
-        return self._value
+def _checked(name, bits):
+    def getter(self):
+        return getattr(self, name)
 
-    @value.setter
-    def value(self, v):
+    def setter(self, v):
         assert isinstance(v, int)
-        assert 0 <= v < (1 << 8)
-        self._value = v
+        assert 0 <= v < (1 << bits)
+        setattr(self, name, v)
+    return property(getter, setter)
 
 
-class Register16:
+class CheckedCpuState(CpuState):
+    '''
+    range checks every register write, for debugging
+    '''
 
-    def __init__(self):
-        self._value = 0
+    __slots__ = ('_a', '_x', '_y', '_sp', '_pc', '_p', '_nz')
 
-    @property
-    def value(self):
-        return self._value
-    
-    @value.setter
-    def value(self, v):
-        assert isinstance(v, int)
-        assert 0 <= v < (1 << 16)
-        self._value = v
+    a = _checked('_a', 8)
+    x = _checked('_x', 8)
+    y = _checked('_y', 8)
+    sp = _checked('_sp', 8)
+    pc = _checked('_pc', 16)
+    p = _checked('_p', 8)
+    nz = _checked('_nz', 9)
 
 
 class Cpu6502:
 
-    def __init__(self, bus: Bus):
+    def __init__(self, bus: Bus, engine=Engine.Interpreter, debug=False):
         self._ins = [
             # 0
             Instruction('BRK', AddrMode.Implied, 7, self.brk),
@@ -552,12 +496,7 @@ class Cpu6502:
             Instruction('ISC', AddrMode.AbslouteIndexedX, 7, self.isc),
         ]
         self._bus = bus
-        self._pc = Register16()
-        self._sp = Register8()
-        self._flag = Flag()
-        self._a = Register8()
-        self._x = Register8()
-        self._y = Register8()
+        self._s = CheckedCpuState() if debug else CpuState()
 
         self._now_cycle = 0
         self._addr = 0
@@ -565,27 +504,92 @@ class Cpu6502:
         self._next_addr = 0
 
         self._nmi_set = False
+        self._frame_end = False
+        self._sync = None
+        # guarded blocks run only if they end before this cycle
+        self._limit = 0
+        self._recorder = None
+
+        self._engine = engine
+        self._handlers = None
+        self._rom_handlers = None
+        # skip iterations of idle loops in run_cycles
+        self.idle_skip = True
+        self.idle_cycles = 0 # cycles skipped so far
+        # Engine.Block compiles a block on its hot_visits-th entry
+        self.hot_visits = HOT_VISITS
+        # run common sequences in ROM loops as one handler. Engine.Dispatch
+        # only: Engine.Block runs whole blocks instead and ignores it, as
+        # every engine does when RAM or PRG are not mapped directly
+        self.fuse = False
+        self.remap()
+
+    def remap(self):
+        '''
+        look up the RAM buffer and the PRG window on the bus again, e.g.
+        after a bank switch, and rebuild the handlers using them
+        '''
+        self._ram = None
+        self._prg = None
+        self._prg_mask = 0
+        self._rom_start = 0x10000
+        ram = self._bus.owner(0x0000)
+        if isinstance(ram, Ram) and self._bus.owner(0x0100) is ram:
+            self._ram = ram.memory()
+        prg = self._bus.owner(0x8000)
+        if isinstance(prg, PGRRom) and all(self._bus.owner(page << 8) is prg for page in range(0x80, 0x100)):
+            self._prg, self._prg_mask = prg.window()
+            self._rom_start = 0x8000
+        self._rom_code = None
+        if self._engine in (Engine.Dispatch, Engine.Block):
+            self._handlers = build_handlers(self)
+            self._rom_handlers = build_handlers(self, self._prg is not None)
+            if self._prg is not None:
+                # ROM handler by pc, fusions replace some of them
+                prg, mask, handlers = self._prg, self._prg_mask, self._rom_handlers
+                self._rom_code = [None] * 0x8000 + [handlers[prg[pc & mask]] for pc in range(0x8000, 0x10000)]
+        # ROM pc -> Block or None; blocks are compiled for the mapped banks
+        # only and dropped here, e.g. on a bank switch
+        self._blocks = None
+        self._block_visits = {}
+        if self._engine == Engine.Block and self._prg is not None and self._ram is not None:
+            self._blocks = {}
+        # jump back pc -> IdleLoop, or None if it does not close an idle loop
+        self._idle_loops = {}
+        # ROM pc -> Fusion, the pcs fusions were found at, the jump back pcs
+        # whose loops were scanned and how often the others jumped back so far
+        self._fusions = {}
+        self._fusion_sites = set()
+        self._fused_loops = set()
+        self._loop_visits = {}
+
+    def direct_memory(self):
+        '''
+        (ram, prg, prg mask) the CPU may access without the bus; ram or prg
+        are None when the bus does not map them to a Ram / PGRRom chip
+        '''
+        return self._ram, self._prg, self._prg_mask
 
     def reset(self):
         lo = self._bus.read(0xfffc)
         hi = self._bus.read(0xfffd)
-        self._pc.value = (hi << 8) + lo
+        self._s.pc = (hi << 8) + lo
         self._now_cycle = 7 # TODO: need to check how many cycles are needed
-        self._sp.value = 0xff
+        self._s.sp = 0xff
         self._push(hi)
         self._push(lo)
-        self._flag.i = True
+        self._set_flag(FLAG_I, True)
         self._nmi_set = False
         
     def test_mode(self):
-        self._pc.value = 0xc000
-        self._sp.value = 0xfd
+        self._s.pc = 0xc000
+        self._s.sp = 0xfd
         self._now_cycle = 7
-        self._flag.i = True
+        self._set_flag(FLAG_I, True)
         self._nmi_set = False
 
     def pre_fill(self, read_data=True):
-        opcode = self._bus.read(self._pc.value)
+        opcode = self.fetch(0)
         ins = self._ins[opcode]
         mode = ins.addr_mode()
         cross_boundry = False
@@ -600,7 +604,7 @@ class Cpu6502:
                 self._data = self._bus.read(self._addr)
         elif mode == AddrMode.Accumulator:
             self._addr = -1
-            self._data = self._a.value
+            self._data = self._s.a
         elif mode == AddrMode.Immediate:
             self._addr = -1
             self._data = self.fetch(1)
@@ -619,12 +623,12 @@ class Cpu6502:
             addr = self.fetch(1)
             lo = self._bus.read(addr)
             hi = self._bus.read((addr + 1) % 256)
-            self._addr = u16((hi << 8) + lo + self._y.value)
+            self._addr = u16((hi << 8) + lo + self._s.y)
             if read_data:
                 self._data = self._bus.read(self._addr)
-            cross_boundry = (lo + self._y.value) > 0xff
+            cross_boundry = (lo + self._s.y) > 0xff
         elif mode == AddrMode.ZeroIndexedIndirectX:
-            index = u8(self.fetch(1) + self._x.value)
+            index = u8(self.fetch(1) + self._s.x)
             self._addr = u16(self._bus.read(index) + ((self._bus.read((index + 1) & 0xff)) << 8))
             if read_data:
                 self._data = self._bus.read(self._addr)
@@ -636,93 +640,444 @@ class Cpu6502:
                 self._addr = self._bus.read(addr) + (self._bus.read(addr + 1) << 8)
             self._data = -1
         elif mode == AddrMode.AbslouteIndexedY:
-            self._addr = u16(self._y.value + self.fetch(1) + (self.fetch(2) << 8))
+            self._addr = u16(self._s.y + self.fetch(1) + (self.fetch(2) << 8))
             if read_data:
                 self._data = self._bus.read(self._addr)
-            cross_boundry = (self._y.value + self.fetch(1) > 0xff)
+            cross_boundry = (self._s.y + self.fetch(1) > 0xff)
         elif mode == AddrMode.ZeroIndexedX:
-            self._addr = u8(self._x.value + self.fetch(1))
+            self._addr = u8(self._s.x + self.fetch(1))
             if read_data:
                 self._data = self._bus.read(self._addr)
         elif mode == AddrMode.ZeroIndexedY:
-            self._addr = u8(self._y.value + self.fetch(1))
+            self._addr = u8(self._s.y + self.fetch(1))
             if read_data:
                 self._data = self._bus.read(self._addr)
         elif mode == AddrMode.AbslouteIndexedX:
-            self._addr = u16(self._x.value + self.fetch(1) + (self.fetch(2) << 8))
+            self._addr = u16(self._s.x + self.fetch(1) + (self.fetch(2) << 8))
             if read_data:
                 self._data = self._bus.read(self._addr)
-            cross_boundry = (self._x.value + self.fetch(1) > 0xff)
+            cross_boundry = (self._s.x + self.fetch(1) > 0xff)
         else:
             assert False, 'Need to impl, {}'.format(mode)
         return cross_boundry
 
+    def flags(self):
+        '''
+        the status register P, with N and Z worked out from the lazy result
+        '''
+        s = self._s
+        return (s.p & 0x7D) | (FLAG_N if s.nz & 0x180 else 0) | (0 if s.nz & 0xFF else FLAG_Z)
+
+    def set_flags(self, p):
+        s = self._s
+        s.p = p
+        s.nz = (p & FLAG_N) << 1 if p & FLAG_Z else (p & FLAG_N) | 1
+
+    def _get_flag(self, mask):
+        if mask == FLAG_Z:
+            return not self._s.nz & 0xFF
+        if mask == FLAG_N:
+            return (self._s.nz & 0x180) != 0
+        return (self._s.p & mask) != 0
+
+    def _set_flag(self, mask, on):
+        if mask & (FLAG_N | FLAG_Z):
+            p = self.flags()
+            self.set_flags(p | mask if on else p & ~mask & 0xFF)
+        elif on:
+            self._s.p |= mask
+        else:
+            self._s.p &= ~mask & 0xFF
+
+    def _set_nz(self, val):
+        self._s.nz = val
+
     def _push(self, val):
-        self._bus.write(self._sp.value + 0x100, val)
-        self._sp.value -= 1
+        if self._ram is None:
+            self._bus.write(self._s.sp + 0x100, val)
+        else:
+            self._ram[self._s.sp + 0x100] = val
+        self._s.sp = (self._s.sp - 1) & 0xFF
     
     def _pop(self):
-        self._sp.value += 1
-        return self._bus.read(self._sp.value + 0x100)
+        self._s.sp = (self._s.sp + 1) & 0xFF
+        if self._ram is None:
+            return self._bus.read(self._s.sp + 0x100)
+        return self._ram[self._s.sp + 0x100]
 
     def request_nmi(self):
         self._nmi_set = True
 
+    def cycle(self):
+        return self._now_cycle
+
+    def end_frame(self):
+        self._frame_end = True
+
+    def set_recorder(self, recorder):
+        '''
+        record every instruction run from now on with
+        recorder.record(pc, opcode, a, x, y, p, sp, cycle), None to stop.
+        while recording, instructions run one at a time: no blocks, fusions
+        or idle skipping
+        '''
+        self._recorder = recorder
+
+    def set_sync(self, func):
+        '''
+        func(cycle) brings the ppu up to `cycle` and returns the cycle of its
+        next event; run_cycles only calls it once that cycle is reached
+        '''
+        self._sync = func
+
+    def registers(self):
+        '''
+        (pc, a, x, y, p, sp), what log() reports without the dict
+        '''
+        s = self._s
+        return s.pc, s.a, s.x, s.y, self.flags(), s.sp
+
+    def state(self):
+        '''
+        (pc, a, x, y, p, sp, cycle, nmi pending) for a save state, p as
+        flags() gives it so the state does not depend on the engine
+        '''
+        s = self._s
+        return s.pc, s.a, s.x, s.y, self.flags(), s.sp, self._now_cycle, self._nmi_set
+
+    def set_state(self, state):
+        s = self._s
+        s.pc, s.a, s.x, s.y, p, s.sp, self._now_cycle, self._nmi_set = state
+        self.set_flags(p)
+
     def log(self):
         status = {
-            'PC': self._pc.value,
-            'A': self._a.value,
-            'X': self._x.value,
-            'Y': self._y.value,
-            'F': self._flag.get(),
-            'SP': self._sp.value,
+            'PC': self._s.pc,
+            'A': self._s.a,
+            'X': self._s.x,
+            'Y': self._s.y,
+            'F': self.flags(),
+            'SP': self._s.sp,
             'CYC': self._now_cycle
         }
         return status
 
     def nmi(self):
-        print('NMI CALLED, addr={:04X}'.format(self._pc.value))
+        if TRACE.mask & CPU_NMI:
+            TRACE.emit(CPU_NMI, self._s.pc)
         self._nmi_set = False
-        self._push((self._pc.value >> 8) & 0xFF)
-        self._push(self._pc.value & 0xFF)
-        self._push(self._flag.get() & 0b11101111)
-        self._flag.i = True
-        self._pc.value = ((self._bus.read(0xFFFB) << 8) | self._bus.read(0xFFFA))
+        self._push((self._s.pc >> 8) & 0xFF)
+        self._push(self._s.pc & 0xFF)
+        self._push(self.flags() & 0b11101111)
+        self._set_flag(FLAG_I, True)
+        self._s.pc = ((self._bus.read(0xFFFB) << 8) | self._bus.read(0xFFFA))
         return False
 
     def irq(self):
         pass
 
     def run(self):
-        pre_cycle = self._now_cycle
-
         if self._nmi_set:
             self.nmi()
             self._now_cycle += 7
-            return self._now_cycle - pre_cycle
+            return 7
 
         #TODO: check irq && brk
-        opcode = self._bus.read(self._pc.value)
+        pc = self._s.pc
+        now = self._now_cycle
+        if self._recorder is not None:
+            cycles = self._step_recorded()
+        elif self._handlers is None:
+            cycles = self._execute()
+        elif pc >= self._rom_start:
+            # one instruction even with Engine.Block, blocks only run from
+            # run_cycles; guarded fusions run their first handler: _limit is 0
+            cycles = self._rom_code[pc]()
+        else:
+            cycles = self._handlers[self._bus.read(pc)]()
+        self._now_cycle = now + cycles
+        return cycles
+
+    def _step_recorded(self):
+        '''
+        record and run the instruction at pc, alone
+        '''
+        s = self._s
+        pc = s.pc
+        opcode = self._bus.read(pc)
+        self._recorder.record(pc, opcode, s.a, s.x, s.y, self.flags(), s.sp, self._now_cycle)
+        if self._handlers is None:
+            return self._execute()
+        if pc >= self._rom_start:
+            # guarded fusions fall back to the single handler: _limit is 0
+            return self._rom_code[pc]()
+        return self._handlers[opcode]()
+
+    def run_cycles(self, budget, until_frame=False):
+        '''
+        run whole instructions until at least `budget` cycles are used or,
+        with `until_frame`, until the PPU reports the start of vblank.
+        returns (cycles used, StopReason)
+        '''
+        if self._recorder is not None:
+            return self._run_recorded(budget, until_frame)
+        handlers = self._handlers
+        rom_start = self._rom_start
+        execute = self._execute
+        read_page = self._bus.read_page
+        state = self._s
+        sync = self._sync
+        idle_loops = self._idle_loops
+        idle_skip = self.idle_skip
+        blocks = self._blocks
+        rom_code = self._rom_code
+        fuse = self.fuse and blocks is None and rom_code is not None and self._ram is not None
+        fused_loops = self._fused_loops
+        start = now = self._now_cycle
+        end = now + budget
+        deadline = _NEVER if sync is None else sync(now)
+        # blocks and fusions only run when they surely end before this
+        limit = self._limit = deadline if deadline < end else end
+        reason = StopReason.Budget
+        self._frame_end = False
+        while now < end:
+            if self._nmi_set:
+                self.nmi()
+                now += 7
+            else:
+                pc = state.pc
+                if handlers is None:
+                    now += execute()
+                elif pc >= rom_start:
+                    if blocks is None:
+                        now += rom_code[pc]()
+                    else:
+                        block = blocks.get(pc, False)
+                        if block is False:
+                            block = self._block(pc)
+                        if block is not None and now + block.max_cycles < limit:
+                            now += block.run(now)
+                            pc = block.last
+                        else:
+                            now += rom_code[pc]()
+                else:
+                    now += handlers[read_page[pc >> 8](pc)]()
+                if state.pc <= pc and pc >= rom_start:
+                    if fuse and pc not in fused_loops:
+                        self._fuse_loop(state.pc, pc)
+                    if idle_skip:
+                        if pc in idle_loops:
+                            loop = idle_loops[pc]
+                        else:
+                            loop = idle_loops[pc] = self._idle_loop(state.pc, pc)
+                        if loop is not None:
+                            now = self._skip_idle(loop, now, deadline, end)
+            self._now_cycle = now
+            if now >= deadline:
+                deadline = sync(now)
+                limit = self._limit = deadline if deadline < end else end
+                if until_frame and self._frame_end:
+                    reason = StopReason.Nmi if self._nmi_set else StopReason.VBlank
+                    break
+        if sync is not None:
+            sync(now)
+        # guarded blocks do not run outside of run_cycles
+        self._limit = 0
+        return now - start, reason
+
+    def _run_recorded(self, budget, until_frame):
+        '''
+        run_cycles for one instruction at a time, recording each
+        '''
+        if self._handlers is None or self._prg is None:
+            return self._run_stepped(budget, until_frame)
+        record = self._recorder.record
+        handlers = self._handlers
+        rom_code = self._rom_code
+        rom_start = self._rom_start
+        prg = self._prg
+        prg_mask = self._prg_mask
+        read_page = self._bus.read_page
+        state = self._s
+        sync = self._sync
+        start = now = self._now_cycle
+        end = now + budget
+        deadline = _NEVER if sync is None else sync(now)
+        reason = StopReason.Budget
+        self._frame_end = False
+        while now < end:
+            if self._nmi_set:
+                self.nmi()
+                now += 7
+            else:
+                pc = state.pc
+                nz = state.nz
+                if pc >= rom_start:
+                    record(pc, prg[pc & prg_mask], state.a, state.x, state.y,
+                           (state.p & 0x7D) | (0x80 if nz & 0x180 else 0) | (0 if nz & 0xFF else 0x02),
+                           state.sp, now)
+                    # fusions fall back to the single handler, _limit is 0
+                    now += rom_code[pc]()
+                else:
+                    opcode = read_page[pc >> 8](pc)
+                    record(pc, opcode, state.a, state.x, state.y,
+                           (state.p & 0x7D) | (0x80 if nz & 0x180 else 0) | (0 if nz & 0xFF else 0x02),
+                           state.sp, now)
+                    now += handlers[opcode]()
+            self._now_cycle = now
+            if now >= deadline:
+                deadline = sync(now)
+                if until_frame and self._frame_end:
+                    reason = StopReason.Nmi if self._nmi_set else StopReason.VBlank
+                    break
+        if sync is not None:
+            sync(now)
+        return now - start, reason
+
+    def _run_stepped(self, budget, until_frame):
+        '''
+        run_cycles through run(), one instruction at a time
+        '''
+        sync = self._sync
+        start = self._now_cycle
+        end = start + budget
+        deadline = _NEVER if sync is None else sync(start)
+        reason = StopReason.Budget
+        self._frame_end = False
+        while self._now_cycle < end:
+            self.run()
+            if self._now_cycle >= deadline:
+                deadline = sync(self._now_cycle)
+                if until_frame and self._frame_end:
+                    reason = StopReason.Nmi if self._nmi_set else StopReason.VBlank
+                    break
+        if sync is not None:
+            sync(self._now_cycle)
+        return self._now_cycle - start, reason
+
+    def _block(self, pc):
+        if pc in self._blocks:
+            return self._blocks[pc]
+        visits = self._block_visits.get(pc, 0) + 1
+        if visits < self.hot_visits:
+            self._block_visits[pc] = visits
+            return None
+        block = self._blocks[pc] = compile_block(self, pc)
+        return block
+
+    def _fuse_loop(self, head, edge):
+        visits = self._loop_visits.get(edge, 0) + 1
+        if visits < HOT_LOOP:
+            self._loop_visits[edge] = visits
+            return
+        self._fused_loops.add(edge)
+        if head < self._rom_start:
+            return
+        for pc, last, pattern in find_fusions(self._ins, self._bus.read, head, edge):
+            if pc not in self._fusion_sites:
+                self._fusion_sites.add(pc)
+                self._rom_code[pc] = self._counted(pc, last, pattern)
+
+    def _counted(self, pc, last, pattern):
+        '''
+        the handler at pc, counting its runs until the fusion found there is
+        hot enough to compile
+        '''
+        rom_code = self._rom_code
+        handler = rom_code[pc]
+        runs = 0
+
+        def counted():
+            nonlocal runs
+            runs += 1
+            if runs == HOT_FUSION:
+                rom_code[pc] = handler
+                self._fuse(pc, last, pattern)
+            return handler()
+        return counted
+
+    def _fuse(self, pc, last, pattern):
+        read = self._bus.read
+        if self._ins[read(last)].addr_mode() == AddrMode.Relative:
+            # run_cycles sees no jump back inside a fusion, keep idle
+            # loops apart so they are still skipped
+            target = u16(last + 2 + s8(read(last + 1)))
+            if self._idle_loop(target, last) is not None:
+                return
+        block = compile_block(self, pc, len(pattern), self._rom_code[pc])
+        # every instruction must be supported by the generator
+        if block is not None and block.last == last:
+            self._fusions[pc] = Fusion(block, pattern)
+            self._rom_code[pc] = block.run
+
+    def fusions(self):
+        '''
+        the Fusions compiled so far
+        '''
+        return list(self._fusions.values())
+
+    def _idle_loop(self, head, edge):
+        def status_chip(addr):
+            chip = self._bus.owner(addr)
+            return chip if isinstance(chip, PPURegister) else None
+        if head < self._rom_start:
+            return None
+        return analyse(self._ins, self._bus.read, head, edge, status_chip)
+
+    def _skip_idle(self, loop, now, deadline, end):
+        '''
+        called when `loop` jumped back to its head at cycle `now`. If the
+        previous iteration started in the same state, run whole iterations
+        at once as long as they end before the next PPU event (`deadline`)
+        and the end of the budget. returns the new cycle count
+        '''
+        s = self._s
+        status = loop.status
+        snapshot = (s.a, s.x, s.y, s.sp, s.p, s.nz, status.poll_state() if status is not None else None)
+        elapsed = now - loop.cycle if loop.cycle is not None else 0
+        # exactly one iteration since the last arrival, nothing else ran
+        if (loop.length <= elapsed <= loop.length + 1 and loop.snapshot == snapshot
+                and loop.deadline == deadline):
+            count = ((deadline if deadline < end else end) - 1 - now) // elapsed
+            if count > 0:
+                now += count * elapsed
+                self.idle_cycles += count * elapsed
+        loop.cycle = now
+        loop.snapshot = snapshot
+        loop.deadline = deadline
+        return now
+
+    def run_frame(self, max_cycles=100000):
+        '''
+        run until the next vblank (or NMI), at most `max_cycles` cycles
+        '''
+        return self.run_cycles(max_cycles, True)
+
+    def _execute(self):
+        opcode = self.fetch(0)
         ins = self._ins[opcode]
-        self._next_addr = self._pc.value + ins.length()
+        self._next_addr = self._s.pc + ins.length()
         cross_boundary = self.pre_fill(ins.name() not in {'STA', 'STX', 'STY'})
         branch_taken = ins.execute()
         if branch_taken is None:
             assert False
-        self._pc.value += ins.pc_increment()
-        self._now_cycle += ins.cycle()
+        self._s.pc += ins.pc_increment()
+        cycles = ins.cycle()
         if ins.name() in {'BPL', 'BMI', 'BVC', 'BVS', 'BCC', 'BCS', 'BNE', 'BEQ'}:
             if branch_taken:
-                self._now_cycle += 1
+                cycles += 1
                 if cross_boundary:
-                    self._now_cycle += 1
+                    cycles += 1
         else:
             if cross_boundary and ins.name() not in {'RRA', 'STA', 'STX', 'STY', 'DCP', 'ISC', 'SLO', 'RLA', 'SRE'}:
-                self._now_cycle += 1
-        return self._now_cycle - pre_cycle
+                cycles += 1
+        return cycles
     
     def fetch(self, index):
-        return self._bus.read(self._pc.value + index)
+        addr = self._s.pc + index
+        if addr >= self._rom_start:
+            return self._prg[addr & self._prg_mask]
+        return self._bus.read(addr)
 
     def decode(self, l, r):
         res = []
@@ -750,25 +1105,24 @@ class Cpu6502:
         return False
 
     def php(self):
-        flag = self._flag.get()
+        flag = self.flags()
         flag |= (1 << 4)
         self._push(flag)
         return False
 
     def bpl(self):
-        if not self._flag.n:
-            self._pc.value = self._pc.value + s8(self._data)
+        if not self._get_flag(FLAG_N):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def clc(self):
-        self._flag.c = False
+        self._set_flag(FLAG_C, False)
         return False
 
     def ora(self):
-        self._a.value |= self._data
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a |= self._data
+        self._set_nz(self._s.a)
         return False
 
     def kil(self):
@@ -777,21 +1131,19 @@ class Cpu6502:
     def asl(self):
         val = u8(self._data << 1)
         if self._addr == -1:
-            self._a.value = u8(self._data << 1)
+            self._s.a = u8(self._data << 1)
         else:
             self._bus.write(self._addr, val)
-        self._flag.c = (self._data >> 7 & 1) == 1
-        self._flag.n = (val >> 7 & 1) == 1
-        self._flag.z = (val == 0)
+        self._set_flag(FLAG_C, (self._data >> 7 & 1) == 1)
+        self._set_nz(val)
         return False
 
     def slo(self):
         v = u8(self._data * 2)
         self._bus.write(self._addr, v)
-        self._a.value |= v
-        self._flag.c = (self._data >> 7 & 1) == 1
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a |= v
+        self._set_flag(FLAG_C, (self._data >> 7 & 1) == 1)
+        self._set_nz(self._s.a)
         return False
 
     def anc(self):
@@ -803,83 +1155,81 @@ class Cpu6502:
         lo = (push & 0xff)
         self._push(hi)
         self._push(lo)
-        self._pc.value = self._addr
+        self._s.pc = self._addr
         return False
 
     def bit(self):
-        self._flag.n = (self._data >> 7 & 1) == 1
-        self._flag.v = (self._data >> 6 & 1) == 1
-        self._flag.z = (self._data & self._a.value) == 0
+        self._set_flag(FLAG_N, (self._data >> 7 & 1) == 1)
+        self._set_flag(FLAG_V, (self._data >> 6 & 1) == 1)
+        self._set_flag(FLAG_Z, (self._data & self._s.a) == 0)
         return False
 
     def plp(self):
-        self._flag.set(self._pop() & 0xef)
+        self.set_flags((self._pop() & 0xef) | (1 << 5))
         return False
 
     def bmi(self):
-        if self._flag.n:
-            self._pc.value = self._pc.value + s8(self._data)
+        if self._get_flag(FLAG_N):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def sec(self):
-        self._flag.c = True
+        self._set_flag(FLAG_C, True)
         return False
 
     def and_(self):
-        self._a.value &= self._data
-        self._flag.z = self._a.value == 0
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a &= self._data
+        self._set_nz(self._s.a)
         return False
 
     def rol(self):
         new_carry = (self._data >> 7 & 1) == 1
         val = u8(self._data << 1)
-        if self._flag.c:
+        if self._get_flag(FLAG_C):
             val |= 1
         if self._addr == -1:
-            self._a.value = val
+            self._s.a = val
         else:
             self._bus.write(self._addr, val)
-        self._flag.c = new_carry
-        self._flag.z = (val == 0)
-        self._flag.n = (val >> 7 & 1) == 1
+        self._set_flag(FLAG_C, new_carry)
+        self._set_nz(val)
         return False
 
     def rla(self):
         # ROL
         new_carry = (self._data >> 7 & 1) == 1
         val = u8(self._data << 1)
-        if self._flag.c:
+        if self._get_flag(FLAG_C):
             val |= 1
         self._bus.write(self._addr, val)
-        self._flag.c = new_carry
+        self._set_flag(FLAG_C, new_carry)
         # AND
-        self._a.value &= val
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a &= val
+        self._set_nz(self._s.a)
         return False
 
     def rti(self):
         flag = self._pop()
         lo = self._pop()
         hi = self._pop()
-        self._pc.value = (hi << 8) + lo
-        self._flag.set(flag)
-        print('RTI CALLED, ADDR={:04X}'.format(self._pc.value))
+        self._s.pc = (hi << 8) + lo
+        self.set_flags(flag | (1 << 5))
+        if TRACE.mask & CPU_RTI:
+            TRACE.emit(CPU_RTI, self._s.pc)
         return False
 
     def pha(self):
-        self._push(self._a.value)
+        self._push(self._s.a)
         return False
 
     def jmp(self):
-        self._pc.value = self._addr
+        self._s.pc = self._addr
         return False
 
     def bvc(self):
-        if not self._flag.v:
-            self._pc.value = self._pc.value + s8(self._data)
+        if not self._get_flag(FLAG_V):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
@@ -887,31 +1237,28 @@ class Cpu6502:
         pass
 
     def eor(self):
-        self._a.value ^= self._data
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a ^= self._data
+        self._set_nz(self._s.a)
         return False
 
     def lsr(self):
         val = (self._data >> 1)
         if self._addr == -1:
-            self._a.value = val
+            self._s.a = val
         else:
             self._bus.write(self._addr, val)
-        self._flag.c = (self._data & 1) == 1
-        self._flag.n = False
-        self._flag.z = val == 0
+        self._set_flag(FLAG_C, (self._data & 1) == 1)
+        self._set_nz(val)
         return False
 
     def sre(self):
         # LSR
         val = (self._data >> 1)
         self._bus.write(self._addr, val)
-        self._flag.c = (self._data & 1) == 1
+        self._set_flag(FLAG_C, (self._data & 1) == 1)
         # EOR
-        self._a.value ^= val
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a ^= val
+        self._set_nz(self._s.a)
         return False
 
     def alr(self):
@@ -920,123 +1267,116 @@ class Cpu6502:
     def rts(self):
         lo = self._pop()
         hi = self._pop()
-        self._pc.value = (hi << 8) + lo
+        self._s.pc = (hi << 8) + lo
         return False
 
     def pla(self):
-        self._a.value = self._pop()
-        self._flag.z = self._a.value == 0
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a = self._pop()
+        self._set_nz(self._s.a)
         return False
 
     def bvs(self):
-        if self._flag.v:
-            self._pc.value = self._pc.value + s8(self._data)
+        if self._get_flag(FLAG_V):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def sei(self):
-        self._flag.i = True
+        self._set_flag(FLAG_I, True)
         return False
 
     def adc(self):
-        c = self._flag.c
-        res = self._a.value + self._data + (1 if c else 0)
-        self._flag.n = (u8(res) >> 7 & 1) == 1
-        self._flag.z = (u8(res) == 0)
-        self._flag.c = (res & 0xff00) != 0
-        ah = (self._a.value >> 7) & 1
+        c = self._get_flag(FLAG_C)
+        res = self._s.a + self._data + (1 if c else 0)
+        self._set_nz(u8(res))
+        self._set_flag(FLAG_C, (res & 0xff00) != 0)
+        ah = (self._s.a >> 7) & 1
         dh = (self._data >> 7) & 1
         rh = (u8(res) >> 7 & 1)
-        self._flag.v = (ah == 0 and dh == 0 and rh == 1) or (ah == 1 and dh == 1 and rh == 0)
-        self._a.value = u8(res)
+        self._set_flag(FLAG_V, (ah == 0 and dh == 0 and rh == 1) or (ah == 1 and dh == 1 and rh == 0))
+        self._s.a = u8(res)
         return False
 
     def ror(self):
         new_carry = (self._data & 1) == 1
         val = self._data >> 1
-        if self._flag.c:
+        if self._get_flag(FLAG_C):
             val |= (1 << 7)
         if self._addr == -1:
-            self._a.value = val
+            self._s.a = val
         else:
             self._bus.write(self._addr, val)
-        self._flag.c = new_carry
-        self._flag.z = (val == 0)
-        self._flag.n = (val >> 7 & 1) == 1
+        self._set_flag(FLAG_C, new_carry)
+        self._set_nz(val)
         return False
 
     def rra(self):
         # ROR
         new_carry = (self._data & 1) == 1
         val = self._data >> 1
-        if self._flag.c:
+        if self._get_flag(FLAG_C):
             val |= (1 << 7)
         self._bus.write(self._addr, val)
         # ADC
         c = new_carry
-        res = self._a.value + val + (1 if c else 0)
-        self._flag.n = (u8(res) >> 7 & 1) == 1
-        self._flag.z = (u8(res) == 0)
-        self._flag.c = (res & 0xff00) != 0
-        ah = (self._a.value >> 7) & 1
+        res = self._s.a + val + (1 if c else 0)
+        self._set_nz(u8(res))
+        self._set_flag(FLAG_C, (res & 0xff00) != 0)
+        ah = (self._s.a >> 7) & 1
         dh = (val >> 7) & 1
         rh = (u8(res) >> 7 & 1)
-        self._flag.v = (ah == 0 and dh == 0 and rh == 1) or (ah == 1 and dh == 1 and rh == 0)
-        self._a.value = u8(res)
+        self._set_flag(FLAG_V, (ah == 0 and dh == 0 and rh == 1) or (ah == 1 and dh == 1 and rh == 0))
+        self._s.a = u8(res)
         return True
 
     def arr(self):
         pass
 
     def sty(self):
-        self._bus.write(self._addr, self._y.value)
+        self._bus.write(self._addr, self._s.y)
         return False
 
     def dey(self):
-        self._y.value = u8(self._y.value - 1)
-        self._flag.z = (self._y.value == 0)
-        self._flag.n = (self._y.value >> 7 & 1) == 1
+        self._s.y = u8(self._s.y - 1)
+        self._set_nz(self._s.y)
         return False
 
     def bcc(self):
-        if not self._flag.c:
-            self._pc.value = self._pc.value + s8(self._data)
+        if not self._get_flag(FLAG_C):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def tya(self):
-        self._a.value = self._y.value
-        self._flag.n = (self._a.value >> 7 & 1) == 1
-        self._flag.z = (self._a.value == 0)
+        self._s.a = self._s.y
+        self._set_nz(self._s.a)
         return False
 
     def shy(self):
         pass
 
     def sta(self):
-        self._bus.write(self._addr, self._a.value)
+        self._bus.write(self._addr, self._s.a)
         return False
 
     def stx(self):
-        self._bus.write(self._addr, self._x.value)
+        self._bus.write(self._addr, self._s.x)
         return False
 
     def txa(self):
-        self._a.value = self._x.value
-        self._flag.n = (self._a.value >> 7 & 1) == 1
-        self._flag.z = (self._a.value == 0)
+        self._s.a = self._s.x
+        self._set_nz(self._s.a)
         return False
 
     def txs(self):
-        self._sp.value = self._x.value
+        self._s.sp = self._s.x
         return False
 
     def shx(self):
         pass
 
     def sax(self):
-        self._bus.write(self._addr, self._a.value & self._x.value)
+        self._bus.write(self._addr, self._s.a & self._s.x)
         return False
 
     def xaa(self):
@@ -1049,169 +1389,151 @@ class Cpu6502:
         pass
 
     def ldy(self):
-        self._y.value = self._data
-        self._flag.n = (self._data >> 7 & 1) == 1
-        self._flag.z = self._data == 0
+        self._s.y = self._data
+        self._set_nz(self._data)
         return False
 
     def tay(self):
-        self._y.value = self._a.value
-        self._flag.n = (self._y.value >> 7 & 1) == 1
-        self._flag.z = (self._y.value == 0)
+        self._s.y = self._s.a
+        self._set_nz(self._s.y)
         return False
 
     def bcs(self):
-        if self._flag.c:
-            self._pc.value = self._pc.value + s8(self._data)
+        if self._get_flag(FLAG_C):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def clv(self):
-        self._flag.v = False
+        self._set_flag(FLAG_V, False)
         return False
 
     def lda(self):
-        self._a.value = self._data
-        self._flag.n = (self._data >> 7 & 1) == 1
-        self._flag.z = self._data == 0
+        self._s.a = self._data
+        self._set_nz(self._data)
         return False
 
     def ldx(self):
-        self._x.value = self._data
-        self._flag.n = (self._data >> 7 & 1) == 1
-        self._flag.z = self._data == 0
+        self._s.x = self._data
+        self._set_nz(self._data)
         return False
 
     def tax(self):
-        self._x.value = self._a.value
-        self._flag.n = (self._x.value >> 7 & 1) == 1
-        self._flag.z = (self._x.value == 0)
+        self._s.x = self._s.a
+        self._set_nz(self._s.x)
         return False
 
     def tsx(self):
-        self._x.value = self._sp.value
-        self._flag.n = (self._x.value >> 7 & 1) == 1
-        self._flag.z = (self._x.value == 0)
+        self._s.x = self._s.sp
+        self._set_nz(self._s.x)
         return False
 
     def lax(self):
-        self._a.value = self._data
-        self._x.value = self._data
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
+        self._s.a = self._data
+        self._s.x = self._data
+        self._set_nz(self._s.a)
         return False
 
     def las(self):
         pass
 
     def cpy(self):
-        value = self._y.value - self._data
-        self._flag.z = (u8(value) == 0)
-        self._flag.n = (u8(value) >> 7 & 1) == 1
-        self._flag.c = (self._y.value >= self._data)
+        value = self._s.y - self._data
+        self._set_nz(u8(value))
+        self._set_flag(FLAG_C, (self._s.y >= self._data))
         return False
 
     def iny(self):
-        self._y.value = u8(self._y.value + 1)
-        self._flag.z = (self._y.value == 0)
-        self._flag.n = (self._y.value >> 7 & 1) == 1
+        self._s.y = u8(self._s.y + 1)
+        self._set_nz(self._s.y)
         return False
 
     def bne(self):
-        if not self._flag.z:
-            self._pc.value = self._pc.value + s8(self._data)
+        if not self._get_flag(FLAG_Z):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def cld(self):
-        self._flag.d = False
+        self._set_flag(FLAG_D, False)
         return False
 
     def cmp(self):
-        value = self._a.value - self._data
-        self._flag.z = (u8(value) == 0)
-        self._flag.n = (u8(value) >> 7 & 1) == 1
-        self._flag.c = (self._a.value >= self._data)
+        value = self._s.a - self._data
+        self._set_nz(u8(value))
+        self._set_flag(FLAG_C, (self._s.a >= self._data))
         return False
 
     def dec(self):
         val = u8(self._data - 1)
         self._bus.write(self._addr, val)
-        self._flag.n = (val >> 7 & 1) == 1
-        self._flag.z = (val == 0)
+        self._set_nz(val)
         return False
 
     def dex(self):
-        self._x.value = u8(self._x.value - 1)
-        self._flag.z = (self._x.value == 0)
-        self._flag.n = (self._x.value >> 7 & 1) == 1
+        self._s.x = u8(self._s.x - 1)
+        self._set_nz(self._s.x)
         return False
 
     def dcp(self):
         v = u8(self._data - 1)
         self._bus.write(self._addr, v)
-        tmp = u8(self._a.value - v)
-        self._flag.z = (tmp == 0)
-        self._flag.n = (tmp >> 7 & 1) == 1
-        self._flag.c = ((self._a.value - v) & 0xff00) == 0
+        tmp = u8(self._s.a - v)
+        self._set_nz(tmp)
+        self._set_flag(FLAG_C, ((self._s.a - v) & 0xff00) == 0)
         return False
 
     def axs(self):
         pass
 
     def cpx(self):
-        value = self._x.value - self._data
-        self._flag.z = (u8(value) == 0)
-        self._flag.n = (u8(value) >> 7 & 1) == 1
-        self._flag.c = (self._x.value >= self._data)
+        value = self._s.x - self._data
+        self._set_nz(u8(value))
+        self._set_flag(FLAG_C, (self._s.x >= self._data))
         return False
 
     def inx(self):
-        self._x.value = u8(self._x.value + 1)
-        self._flag.z = (self._x.value == 0)
-        self._flag.n = (self._x.value >> 7 & 1) == 1
+        self._s.x = u8(self._s.x + 1)
+        self._set_nz(self._s.x)
         return False
 
     def beq(self):
-        if self._flag.z:
-            self._pc.value = self._pc.value + s8(self._data)
+        if self._get_flag(FLAG_Z):
+            self._s.pc = self._s.pc + s8(self._data)
             return True
         return False
 
     def sed(self):
-        self._flag.d = True
+        self._set_flag(FLAG_D, True)
         return False
 
     def sbc(self):
-        c = self._flag.c
-        res = self._a.value - self._data - (0 if c else 1)
-        self._flag.n = (u8(res) >> 7 & 1) == 1
-        self._flag.z = u8(res) == 0
-        self._flag.c = (res & 0xff00) == 0
-        ah = self._a.value >> 7 & 1
+        c = self._get_flag(FLAG_C)
+        res = self._s.a - self._data - (0 if c else 1)
+        self._set_nz(u8(res))
+        self._set_flag(FLAG_C, (res & 0xff00) == 0)
+        ah = self._s.a >> 7 & 1
         mh = self._data >> 7 & 1
         rh = u8(res) >> 7 & 1
-        self._flag.v = (ah == 1 and mh == 0 and rh == 0) or (ah == 0 and mh == 1 and rh == 1)
-        self._a.value = u8(res)
+        self._set_flag(FLAG_V, (ah == 1 and mh == 0 and rh == 0) or (ah == 0 and mh == 1 and rh == 1))
+        self._s.a = u8(res)
         return False
 
     def inc(self):
         val = u8(1 + self._data)
         self._bus.write(self._addr, val)
-        self._flag.z = (val == 0)
-        self._flag.n = (val >> 7 & 1) == 1
+        self._set_nz(val)
         return False
 
     def isc(self):
         v = u8(self._data + 1)
-        tmp = self._a.value - v - (0 if self._flag.c else 1)
+        tmp = self._s.a - v - (0 if self._get_flag(FLAG_C) else 1)
         self._bus.write(self._addr, v)
-        self._flag.z = (self._a.value == 0)
-        self._flag.n = (self._a.value >> 7 & 1) == 1
-        self._flag.c = (tmp & 0xff00) == 0
-        ah = (self._a.value >> 7 & 1)
+        self._set_nz(self._s.a)
+        self._set_flag(FLAG_C, (tmp & 0xff00) == 0)
+        ah = (self._s.a >> 7 & 1)
         mh = (v >> 7 & 1)
         rh = (u8(tmp) >> 7 & 1)
-        self._flag.v = (ah == 0 and mh == 1 and rh == 1) or (ah == 1 and mh == 0 and rh == 0) 
-        self._a.value = u8(tmp)
+        self._set_flag(FLAG_V, (ah == 0 and mh == 1 and rh == 1) or (ah == 1 and mh == 0 and rh == 0) )
+        self._s.a = u8(tmp)
         return False
@@ -0,0 +1,66 @@
+import sys
+import time
+from chip import *
+from cpu import Cpu6502, Engine
+from bus import Bus
+from nes import Nes
+
+
+def nestest_cpu(nes, engine, debug):
+    ppu_bus = Bus()
+    ppu_bus.connect(PatternTable())
+    ppu_bus.connect(NameTable())
+    ppu_bus.connect(PaletteTable())
+    pgr = PGRRom()
+    pgr.load(nes.pgr)
+    bus = Bus()
+    bus.connect(pgr)
+    bus.connect(Ram())
+    bus.connect(PAuExp())
+    bus.connect(PPURegister(ppu_bus))
+    cpu = Cpu6502(bus, engine, debug)
+    cpu.test_mode()
+    return cpu
+
+
+def nestest_cycles(nes, count):
+    '''
+    cycle reached after the first `count` instructions of the nestest trace
+    '''
+    cpu = nestest_cpu(nes, Engine.Interpreter, False)
+    for _ in range(count):
+        cpu.run()
+    return cpu.cycle()
+
+
+def per_instruction(nes, engine, debug, count=8990, repeat=10):
+    '''
+    best time per instruction (ns) running the first `count` instructions
+    of the nestest trace. runs up to their last cycle with run_cycles, as
+    Engine.Block only runs blocks from there
+    '''
+    cycles = nestest_cycles(nes, count)
+    best = None
+    for _ in range(repeat):
+        cpu = nestest_cpu(nes, engine, debug)
+        start = time.perf_counter()
+        cpu.run_cycles(cycles - cpu.cycle())
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e9 / count
+
+
+def main():
+    nes = Nes()
+    nes.load('roms/nestest.nes')
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for engine in Engine:
+        for debug in [False, True]:
+            ns = per_instruction(nes, engine, debug, repeat=repeat)
+            print('{:<12} {:<8} {:8.0f} ns/ins'.format(
+                engine.name, 'checked' if debug else 'plain', ns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import sys
+import struct
+import numpy as np
+from bus import Bus
+from console import Console
+from cpu import Cpu6502, Engine
+
+
+# one record per instruction: pc, opcode, a, x, y, p, sp, cycle
+RECORD = struct.Struct('<HBBBBBBQ')
+DTYPE = np.dtype([
+    ('pc', '<u2'), ('opcode', 'u1'), ('a', 'u1'), ('x', 'u1'), ('y', 'u1'),
+    ('p', 'u1'), ('sp', 'u1'), ('cycle', '<u8'),
+])
+assert DTYPE.itemsize == RECORD.size
+
+# nestest logs show the PPU at dot 0 of line 0 at this cycle
+NESTEST_FIRST_CYCLE = 7
+
+
+class TraceRecorder:
+    '''
+    appends one RECORD per instruction to a preallocated buffer and writes
+    it to `path` whenever `chunk` records are collected. Attach it with
+    Cpu6502.set_recorder
+    '''
+
+    def __init__(self, path, chunk=1 << 16):
+        self._file = open(path, 'wb')
+        self._buf = bytearray(RECORD.size * chunk)
+        self._pos = 0
+        self._written = 0
+        self._pack_into = RECORD.pack_into
+
+    def record(self, pc, opcode, a, x, y, p, sp, cycle):
+        self._pack_into(self._buf, self._pos, pc, opcode, a, x, y, p, sp, cycle)
+        self._pos += RECORD.size
+        if self._pos == len(self._buf):
+            self.flush()
+
+    def count(self):
+        return self._written + self._pos // RECORD.size
+
+    def flush(self):
+        self._file.write(memoryview(self._buf)[:self._pos])
+        self._written += self._pos // RECORD.size
+        self._pos = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load(path):
+    '''
+    the records of a trace file as a numpy structured array
+    '''
+    return np.fromfile(path, dtype=DTYPE)
+
+
+def _names():
+    return [ins.name() for ins in Cpu6502(Bus())._ins]
+
+
+def to_text(records, out, names=None):
+    '''
+    write records as nestest log lines. Operand bytes and disassembly are not
+    recorded, only the opcode and its mnemonic are shown; the PPU column is
+    derived from the cycle the way nestest counts it, 341 dots by 262 lines
+    '''
+    names = names or _names()
+    for r in records.tolist():
+        pc, opcode, a, x, y, p, sp, cycle = r
+        line, dot = divmod(max(cycle - NESTEST_FIRST_CYCLE, 0) * 3, 341)
+        out.write('{:04X}  {:02X}        {:<32}A:{:02X} X:{:02X} Y:{:02X} P:{:02X} SP:{:02X} PPU:{},{} CYC:{}\n'.format(
+            pc, opcode, names[opcode], a, x, y, p, sp, dot, line % 262, cycle))
+
+
+def first_difference(a, b):
+    '''
+    index of the first record where traces a and b differ, None if they are
+    equal. A trace that is a prefix of the other differs at its end
+    '''
+    count = min(len(a), len(b))
+    diff = np.flatnonzero(a[:count] != b[:count])
+    if len(diff):
+        return int(diff[0])
+    if len(a) != len(b):
+        return count
+    return None
+
+
+def diff(a, b, out, context=5):
+    '''
+    report the first difference of traces a and b with `context` records
+    before it. returns its index or None
+    '''
+    i = first_difference(a, b)
+    if i is None:
+        out.write('traces are equal, {} records\n'.format(len(a)))
+        return None
+    names = _names()
+    start = max(0, i - context)
+    out.write('first difference at record {}\n'.format(i))
+    for label, trace in (('a', a), ('b', b)):
+        out.write('{}:\n'.format(label))
+        to_text(trace[start:i + 1], out, names)
+        if i >= len(trace):
+            out.write('<end of trace, {} records>\n'.format(len(trace)))
+    if i < min(len(a), len(b)):
+        fields = [name for name in DTYPE.names if a[i][name] != b[i][name]]
+        out.write('differs in: {}\n'.format(', '.join(fields)))
+    return i
+
+
+def record(rom, frames, path, engine=Engine.Dispatch):
+    '''
+    run `frames` frames of a rom, tracing every instruction into `path`
+    '''
+    console = Console(rom, engine)
+    with TraceRecorder(path) as recorder:
+        console.get_cpu().set_recorder(recorder)
+        for _ in range(frames):
+            console.run_frame()
+        console.get_cpu().set_recorder(None)
+        return recorder.count()
+
+
+def main():
+    '''
+    python cpu_trace.py record rom frames out.bin [engine]
+    python cpu_trace.py text trace.bin [first] [count]
+    python cpu_trace.py diff a.bin b.bin
+    '''
+    command = sys.argv[1]
+    if command == 'record':
+        engine = Engine[sys.argv[5]] if len(sys.argv) > 5 else Engine.Dispatch
+        count = record(sys.argv[2], int(sys.argv[3]), sys.argv[4], engine)
+        print('{} instructions recorded'.format(count))
+    elif command == 'text':
+        records = load(sys.argv[2])
+        first = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        count = int(sys.argv[4]) if len(sys.argv) > 4 else len(records)
+        to_text(records[first:first + count], sys.stdout)
+    elif command == 'diff':
+        if diff(load(sys.argv[2]), load(sys.argv[3]), sys.stdout) is not None:
+            sys.exit(1)
+    else:
+        print(main.__doc__)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
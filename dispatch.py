@@ -0,0 +1,501 @@
+import re
+from tracer import TRACE, CPU_RTI
+
+
+# Address computation for every addressing mode: (lines, page cross expression).
+# The lines leave the effective address in `addr` (or the operand in `data`).
+ADDRESS = {
+    'Implied': ([], None),
+    'Accumulator': (['data = a'], None),
+    'Immediate': (['data = fetch(1)'], None),
+    'Relative': (['data = fetch(1)'], None),
+    'Absolute': (['addr = fetch(1) | (fetch(2) << 8)'], None),
+    'ZeroPage': (['addr = fetch(1)'], None),
+    'ZeroIndexedX': (['addr = (fetch(1) + x) & 0xFF'], None),
+    'ZeroIndexedY': (['addr = (fetch(1) + y) & 0xFF'], None),
+    'AbslouteIndexedX': ([
+        'lo = fetch(1)',
+        'addr = (lo + x + (fetch(2) << 8)) & 0xFFFF',
+    ], 'lo + x > 0xFF'),
+    'AbslouteIndexedY': ([
+        'lo = fetch(1)',
+        'addr = (lo + y + (fetch(2) << 8)) & 0xFFFF',
+    ], 'lo + y > 0xFF'),
+    'ZeroIndexedIndirectX': ([
+        'zp = (fetch(1) + x) & 0xFF',
+        'addr = ram_read(zp) | (ram_read((zp + 1) & 0xFF) << 8)',
+    ], None),
+    'IndexedIndirectY': ([
+        'zp = fetch(1)',
+        'lo = ram_read(zp)',
+        'addr = ((ram_read((zp + 1) & 0xFF) << 8) + lo + y) & 0xFFFF',
+    ], 'lo + y > 0xFF'),
+    'AbslouteIndirect': ([
+        'ptr = fetch(1) | (fetch(2) << 8)',
+        'addr = read(ptr) | (read((ptr & 0xFF00) | ((ptr + 1) & 0xFF)) << 8)',
+    ], None),
+}
+
+# modes whose operand lives in memory at `addr`
+MEMORY_MODES = {
+    'Absolute', 'ZeroPage', 'ZeroIndexedX', 'ZeroIndexedY', 'AbslouteIndexedX',
+    'AbslouteIndexedY', 'ZeroIndexedIndirectX', 'IndexedIndirectY'
+}
+
+# modes whose operand is always in the zero page, i.e. internal RAM
+ZERO_MODES = {'ZeroPage', 'ZeroIndexedX', 'ZeroIndexedY'}
+
+# instructions which never look at the operand byte
+NO_READ = {'STA', 'STX', 'STY', 'JMP', 'JSR'}
+
+# instructions without the extra cycle on page cross
+NO_PENALTY = {'RRA', 'STA', 'STX', 'STY', 'DCP', 'ISC', 'SLO', 'RLA', 'SRE'}
+
+BRANCHES = {
+    'BPL': 'not $N',
+    'BMI': '$N',
+    'BVC': 'not $V',
+    'BVS': '$V',
+    'BCC': 'not $C',
+    'BCS': '$C',
+    'BNE': 'not $Z',
+    'BEQ': '$Z',
+}
+
+# instructions which set `pc` by themselves
+CONTROL = {'JMP', 'JSR', 'RTS', 'RTI'} | set(BRANCHES)
+
+# The semantics of every implemented instruction, mirroring the methods of
+# Cpu6502. `store(v)` writes back to A or memory depending on the mode,
+# set_nz(v) sets N and Z from v, set_nz(n, z) N from n and Z from z.
+OPS = {
+    'NOP': [],
+    'ORA': ['a |= data', 'set_nz(a)'],
+    'AND': ['a &= data', 'set_nz(a)'],
+    'EOR': ['a ^= data', 'set_nz(a)'],
+    'ADC': [
+        'res = a + data + (1 if $C else 0)',
+        'val = res & 0xFF',
+        'set_c(res > 0xFF)',
+        'set_v(((a ^ val) & (data ^ val) & 0x80) != 0)',
+        'a = val',
+        'set_nz(a)',
+    ],
+    'SBC': [
+        'res = a - data - (0 if $C else 1)',
+        'val = res & 0xFF',
+        'set_c(res >= 0)',
+        'set_v(((a ^ data) & (a ^ val) & 0x80) != 0)',
+        'a = val',
+        'set_nz(a)',
+    ],
+    'CMP': ['set_nz((a - data) & 0xFF)', 'set_c(a >= data)'],
+    'CPX': ['set_nz((x - data) & 0xFF)', 'set_c(x >= data)'],
+    'CPY': ['set_nz((y - data) & 0xFF)', 'set_c(y >= data)'],
+    'BIT': [
+        'set_nz(data, data & a)',
+        'set_v((data & 0x40) != 0)',
+    ],
+    'LDA': ['a = data', 'set_nz(a)'],
+    'LDX': ['x = data', 'set_nz(x)'],
+    'LDY': ['y = data', 'set_nz(y)'],
+    'LAX': ['a = data', 'x = data', 'set_nz(a)'],
+    'STA': ['write(addr, a)'],
+    'STX': ['write(addr, x)'],
+    'STY': ['write(addr, y)'],
+    'SAX': ['write(addr, a & x)'],
+    'TAX': ['x = a', 'set_nz(x)'],
+    'TAY': ['y = a', 'set_nz(y)'],
+    'TXA': ['a = x', 'set_nz(a)'],
+    'TYA': ['a = y', 'set_nz(a)'],
+    'TSX': ['x = sp', 'set_nz(x)'],
+    'TXS': ['sp = x'],
+    'INX': ['x = (x + 1) & 0xFF', 'set_nz(x)'],
+    'INY': ['y = (y + 1) & 0xFF', 'set_nz(y)'],
+    'DEX': ['x = (x - 1) & 0xFF', 'set_nz(x)'],
+    'DEY': ['y = (y - 1) & 0xFF', 'set_nz(y)'],
+    'INC': ['val = (data + 1) & 0xFF', 'write(addr, val)', 'set_nz(val)'],
+    'DEC': ['val = (data - 1) & 0xFF', 'write(addr, val)', 'set_nz(val)'],
+    'ASL': [
+        'val = (data << 1) & 0xFF',
+        'store(val)',
+        'set_c(data >= 0x80)',
+        'set_nz(val)',
+    ],
+    'LSR': [
+        'val = data >> 1',
+        'store(val)',
+        'set_c((data & 1) == 1)',
+        'set_nz(val)',
+    ],
+    'ROL': [
+        'val = ((data << 1) & 0xFF) | (1 if $C else 0)',
+        'store(val)',
+        'set_c(data >= 0x80)',
+        'set_nz(val)',
+    ],
+    'ROR': [
+        'val = (data >> 1) | (0x80 if $C else 0)',
+        'store(val)',
+        'set_c((data & 1) == 1)',
+        'set_nz(val)',
+    ],
+    'SLO': [
+        'val = (data << 1) & 0xFF',
+        'write(addr, val)',
+        'a |= val',
+        'set_c(data >= 0x80)',
+        'set_nz(a)',
+    ],
+    'RLA': [
+        'val = ((data << 1) & 0xFF) | (1 if $C else 0)',
+        'write(addr, val)',
+        'a &= val',
+        'set_c(data >= 0x80)',
+        'set_nz(a)',
+    ],
+    'SRE': [
+        'val = data >> 1',
+        'write(addr, val)',
+        'a ^= val',
+        'set_c((data & 1) == 1)',
+        'set_nz(a)',
+    ],
+    'RRA': [
+        'val = (data >> 1) | (0x80 if $C else 0)',
+        'write(addr, val)',
+        'res = a + val + (data & 1)',
+        'data = res & 0xFF',
+        'set_c(res > 0xFF)',
+        'set_v(((a ^ data) & (val ^ data) & 0x80) != 0)',
+        'a = data',
+        'set_nz(a)',
+    ],
+    'DCP': [
+        'val = (data - 1) & 0xFF',
+        'write(addr, val)',
+        'set_nz((a - val) & 0xFF)',
+        'set_c(a >= val)',
+    ],
+    'ISC': [
+        # Z and N come from A before the subtraction, like Cpu6502.isc
+        'val = (data + 1) & 0xFF',
+        'res = a - val - (0 if $C else 1)',
+        'write(addr, val)',
+        'set_nz(a)',
+        'set_c(res >= 0)',
+        'set_v(((a ^ val) & (a ^ res) & 0x80) != 0)',
+        'a = res & 0xFF',
+    ],
+    'CLC': ['set_c(False)'],
+    'SEC': ['set_c(True)'],
+    'CLV': ['set_v(False)'],
+    'CLD': ['set_d(False)'],
+    'SED': ['set_d(True)'],
+    'SEI': ['set_i(True)'],
+    'PHA': ['push(a)'],
+    'PLA': ['a = pop()', 'set_nz(a)'],
+    'PHP': ['push($P | 0x10)'],
+    'PLP': ['val = pop()', 'set_p(val & 0xEF)'],
+    'JMP': ['pc = addr'],
+    'JSR': [
+        'val = pc + 2',
+        'push(val >> 8)',
+        'push(val & 0xFF)',
+        'pc = addr',
+    ],
+    'RTS': ['lo = pop()', 'hi = pop()', 'pc = (hi << 8) + lo + 1'],
+    'RTI': [
+        'val = pop()',
+        'lo = pop()',
+        'hi = pop()',
+        'pc = (hi << 8) + lo',
+        'set_p(val)',
+        'if TRACE.mask & CPU_RTI:',
+        '    TRACE.emit(CPU_RTI, pc)',
+    ],
+}
+
+for _name, _cond in BRANCHES.items():
+    OPS[_name] = [
+        'val = pc + 2',
+        'if {}:'.format(_cond),
+        '    pc = val + ((data ^ 0x80) - 0x80)',
+        '    cycles = 4 if (pc ^ val) & 0xFF00 else 3',
+        'else:',
+        '    pc = val',
+        '    cycles = 2',
+    ]
+
+REGISTERS = ('a', 'x', 'y', 'sp', 'p', 'nz')
+
+# flags kept in p; N and Z live in nz, see cpu.CpuState
+FLAG_BITS = {
+    'V': 0x40,
+    'D': 0x08,
+    'I': 0x04,
+    'C': 0x01,
+}
+
+LAZY_FLAGS = {
+    'N': ('(nz & 0x180)', '(not nz & 0x180)'),
+    'Z': ('(not nz & 0xFF)', '(nz & 0xFF)'),
+}
+
+# P with N and Z put in, and nz for the N and Z bits of p
+FULL_P = '((p & 0x7D) | (0x80 if nz & 0x180 else 0) | (0 if nz & 0xFF else 0x02))'
+NZ_OF_P = '(p & 0x80) << 1 if p & 0x02 else (p & 0x80) | 1'
+
+_STATEMENT = re.compile(r'^(\s*)(\w+)\((.*)\)$')
+_POP = re.compile(r'^(\s*)(\w+) = pop\(\)$')
+_FLAG = re.compile(r'(not )?\$([A-Z])')
+_FETCH = re.compile(r'fetch\((\d)\)')
+
+
+def _flag_read(match):
+    negate, flag = match.groups()
+    if flag in LAZY_FLAGS:
+        return LAZY_FLAGS[flag][1 if negate else 0]
+    negate = negate or ''
+    if flag == 'P':
+        return negate + FULL_P
+    return '{}(p & 0x{:02X})'.format(negate, FLAG_BITS[flag])
+
+
+def bus_fetch(index):
+    return 'read(pc + {})'.format(index)
+
+
+def rom_fetch(mask):
+    '''
+    operand fetch straight from the PRG window, for code running from ROM
+    '''
+    def fetch(index):
+        return 'PRG[(pc + {}) & 0x{:04X}]'.format(index, mask)
+    return fetch
+
+
+def expand(line, mode, fetch=bus_fetch):
+    '''
+    expand the macros of one template line into plain python lines;
+    fetch(index) gives the source reading the operand byte at pc + index
+    '''
+    line = _FLAG.sub(_flag_read, line)
+    line = _FETCH.sub(lambda m: fetch(int(m.group(1))), line)
+    match = _POP.match(line)
+    if match:
+        indent, target = match.groups()
+        return [
+            indent + 'sp = (sp + 1) & 0xFF',
+            indent + '{} = ram_read(0x100 + sp)'.format(target),
+        ]
+    match = _STATEMENT.match(line)
+    if match is None:
+        return [line]
+    indent, name, arg = match.groups()
+    if name == 'set_nz':
+        if ', ' not in arg:
+            return [indent + 'nz = {}'.format(arg)]
+        n, z = arg.split(', ')
+        return [indent + 'nz = ({0} & 0x80) | 1 if {1} else ({0} & 0x80) << 1'.format(n, z)]
+    if name == 'set_p':
+        return [indent + 'p = ({}) | 0x20'.format(arg), indent + 'nz = ' + NZ_OF_P]
+    if name.startswith('set_') and name[4:].upper() in FLAG_BITS:
+        bit = FLAG_BITS[name[4:].upper()]
+        if arg == 'True':
+            return [indent + 'p |= 0x{:02X}'.format(bit)]
+        if arg == 'False':
+            return [indent + 'p &= 0x{:02X}'.format(0xFF ^ bit)]
+        return [indent + 'p = p | 0x{:02X} if {} else p & 0x{:02X}'.format(bit, arg, 0xFF ^ bit)]
+    if name == 'push':
+        return [
+            indent + 'ram_write(0x100 + sp, {})'.format(arg),
+            indent + 'sp = (sp - 1) & 0xFF',
+        ]
+    if name == 'store':
+        if mode == 'Accumulator':
+            return [indent + 'a = {}'.format(arg)]
+        return [indent + 'write(addr, {})'.format(arg)]
+    return [line]
+
+
+def zero_page(line, mode):
+    if mode in ZERO_MODES:
+        return line.replace('read(addr)', 'ram_read(addr)').replace('write(addr,', 'ram_write(addr,')
+    return line
+
+
+def _split_call(line, name):
+    '''
+    find the first call `name(...)` in line: (start, end, [args]) or None
+    '''
+    match = re.search(r'\b{}\('.format(name), line)
+    if match is None:
+        return None
+    depth = 0
+    args = []
+    arg_start = match.end()
+    for pos in range(match.end() - 1, len(line)):
+        ch = line[pos]
+        if ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                args.append(line[arg_start:pos].strip())
+                return match.start(), pos + 1, args
+        elif ch == ',' and depth == 1:
+            args.append(line[arg_start:pos].strip())
+            arg_start = pos + 1
+    raise SyntaxError('unbalanced call in: {}'.format(line))
+
+
+def _page(addr):
+    if addr.isidentifier():
+        return '{} >> 8'.format(addr)
+    return '({}) >> 8'.format(addr)
+
+
+def bus_calls(line, ram=False):
+    '''
+    index the bus page tables directly instead of calling Bus.read/write;
+    with `ram`, zero page and stack accesses index the RAM buffer instead
+    '''
+    match = re.match(r'^(\s*)ram_write\(', line)
+    if match:
+        _, _, (addr, value) = _split_call(line, 'ram_write')
+        if ram:
+            return '{}RAM[{}] = {}'.format(match.group(1), addr, value)
+        line = '{}write({}, {})'.format(match.group(1), addr, value)
+    while True:
+        call = _split_call(line, 'ram_read')
+        if call is None:
+            break
+        start, end, (addr,) = call
+        line = line[:start] + ('RAM[{}]' if ram else 'read({})').format(addr) + line[end:]
+    while True:
+        call = _split_call(line, 'read')
+        if call is None:
+            break
+        start, end, (addr,) = call
+        line = line[:start] + 'RD[{}]({})'.format(_page(addr), addr) + line[end:]
+    while True:
+        call = _split_call(line, 'write')
+        if call is None:
+            break
+        start, end, (addr, value) = call
+        line = line[:start] + 'WR[{}]({}, {})'.format(_page(addr), addr, value) + line[end:]
+    return line
+
+
+def assigned(lines, reg):
+    pattern = re.compile(r'^\s*{}\s*[|&^+\-]?=(?!=)'.format(reg))
+    return any(pattern.match(line) for line in lines)
+
+
+def read_first(lines, reg):
+    '''
+    whether the value reg had before the lines may be read, i.e. it is used
+    before an unconditional assignment
+    '''
+    pattern = re.compile(r'\b{}\b'.format(reg))
+    store = re.compile(r'^{} = (.*)$'.format(reg))
+    for line in lines:
+        match = store.match(line)
+        if match and not pattern.search(match.group(1)):
+            return False
+        if pattern.search(line):
+            return True
+    return False
+
+
+def template(ins):
+    '''
+    (template lines, cycles expression) of one instruction before macro
+    expansion, or None if the instruction is not supported by the generator.
+    the lines end with the pc update unless the instruction sets pc itself
+    '''
+    name = ins.name()
+    mode = ins.addr_mode().name
+    if name not in OPS or mode not in ADDRESS:
+        return None
+    addr_lines, cross = ADDRESS[mode]
+    lines = list(addr_lines)
+    if mode in MEMORY_MODES and name not in NO_READ:
+        lines.append('data = read(addr)')
+    lines.extend(OPS[name])
+    if name not in CONTROL:
+        lines.append('pc = pc + {}'.format(ins.length()))
+    if name in BRANCHES:
+        cycles = 'cycles'
+    elif cross is not None and name not in NO_PENALTY:
+        cycles = '{} + ({})'.format(ins.cycle(), cross)
+    else:
+        cycles = str(ins.cycle())
+    return lines, cycles
+
+
+def instruction_source(ins, fetch=bus_fetch, ram=False):
+    '''
+    python source for the body of one instruction, or None if the
+    instruction is not supported by the generator
+    '''
+    res = template(ins)
+    if res is None:
+        return None
+    lines, cycles = res
+    mode = ins.addr_mode().name
+    body = []
+    for line in lines:
+        for l in expand(line, mode, fetch):
+            body.append(bus_calls(zero_page(l, mode), ram))
+    return body, cycles
+
+
+def handler_source(opcode, ins, fetch=bus_fetch, ram=False):
+    res = instruction_source(ins, fetch, ram)
+    if res is None:
+        return None
+    body, cycles = res
+    head = ['pc = S.pc']
+    tail = ['S.pc = pc']
+    for reg in REGISTERS:
+        if read_first(body, reg):
+            head.append('{0} = S.{0}'.format(reg))
+        if assigned(body, reg):
+            tail.append('S.{0} = {0}'.format(reg))
+    lines = ['def op_{:02X}():'.format(opcode)]
+    lines.extend('    ' + line for line in head + body + tail)
+    lines.append('    return {}'.format(cycles))
+    return '\n'.join(lines)
+
+
+def build_handlers(cpu, rom=False):
+    '''
+    turn every opcode into one specialized function returning the cycles it
+    took; opcodes the generator does not know fall back to cpu._execute.
+    with `rom` the handlers fetch operands from the PRG window and may only
+    run for pc >= 0x8000
+    '''
+    bus = cpu._bus
+    ram, prg, mask = cpu.direct_memory()
+    namespace = {
+        'RD': bus.read_page,
+        'WR': bus.write_page,
+        'S': cpu._s,
+        'RAM': ram,
+        'PRG': prg,
+        'TRACE': TRACE,
+        'CPU_RTI': CPU_RTI,
+    }
+    fetch = rom_fetch(mask) if rom else bus_fetch
+    sources = []
+    for opcode, ins in enumerate(cpu._ins):
+        src = handler_source(opcode, ins, fetch, ram is not None)
+        if src is not None:
+            sources.append(src)
+    exec(compile('\n\n'.join(sources), '<dispatch>', 'exec'), namespace)
+    handlers = []
+    for opcode in range(256):
+        handlers.append(namespace.get('op_{:02X}'.format(opcode), cpu._execute))
+    return handlers
@@ -0,0 +1,129 @@
+# Superinstructions: short opcode sequences inside hot loops, compiled into
+# one handler each so the dispatcher runs them with a single call, e.g.
+#
+#     copy: LDA $0300,X        wait: DEX        next: INY
+#           STA $0400,X              BNE wait         CPY #$10
+#                                                     BNE next
+#
+# Loops are found where a branch or JMP in ROM jumps back; their bodies and
+# the subroutines they call are scanned once for the sequences below. The
+# handlers are blocks (see block.py) of the fused instructions only,
+# compiled once the first one ran HOT_FUSION times and put into the per pc
+# handler table of the ROM in its place. Only Engine.Dispatch fuses,
+# Engine.Block already runs whole blocks as one call.
+
+# fused sequences, longest first. Besides the usual copy and counter loops
+# these are the most frequent runs in the hot code of the roms in roms/
+FUSIONS = [
+    ('INX', 'CPX', 'BNE'),
+    ('INY', 'CPY', 'BNE'),
+    ('DEY', 'CPY', 'BNE'),
+    ('STA', 'DEX', 'BNE'),
+    ('STA', 'DEY', 'BNE'),
+    ('LDA', 'AND', 'STA'),
+    ('LDA', 'AND', 'BEQ'),
+    ('LDA', 'AND', 'BNE'),
+    ('LDA', 'CMP', 'BCC'),
+    ('LDA', 'CMP', 'BCS'),
+    ('CLC', 'ADC', 'STA'),
+    ('SEC', 'SBC', 'STA'),
+    ('LDA', 'STA'),
+    ('LDX', 'STX'),
+    ('LDY', 'STY'),
+    ('CLC', 'ADC'),
+    ('SEC', 'SBC'),
+    ('ASL', 'ASL'),
+    ('LSR', 'LSR'),
+    ('ROL', 'ROL'),
+    ('ROR', 'ROR'),
+    ('CMP', 'BNE'),
+    ('CMP', 'BEQ'),
+    ('CPX', 'BNE'),
+    ('CPY', 'BNE'),
+    ('DEX', 'BNE'),
+    ('DEY', 'BNE'),
+    ('DEX', 'BPL'),
+    ('DEY', 'BPL'),
+    ('INX', 'BNE'),
+    ('INY', 'BNE'),
+]
+
+# FUSIONS by their first instruction, longest first
+_STARTING = {first: [pattern for pattern in FUSIONS if pattern[0] == first]
+             for first, *_ in FUSIONS}
+
+# a loop is scanned when it jumps back for the HOT_LOOP-th time
+HOT_LOOP = 64
+
+# a fusion found in a loop is compiled when its first instruction ran for
+# the HOT_FUSION-th time: compiling one costs about what a few thousand
+# fused runs save
+HOT_FUSION = 1024
+
+# loop bodies and subroutines longer than this, in bytes, are not scanned
+MAX_LOOP = 256
+
+# a subroutine is scanned up to the first of these
+RETURNS = {'RTS', 'RTI', 'JMP'}
+
+
+class Fusion:
+
+    __slots__ = ('block', 'pattern')
+
+    def __init__(self, block, pattern):
+        # a guarded Block, see block.compile_block
+        self.block = block
+        self.pattern = pattern
+
+    def fired(self):
+        '''
+        times run instead of the separate handlers
+        '''
+        return self.block.runs
+
+    def name(self):
+        return '/'.join(self.pattern)
+
+
+def _scan(instructions, read, pc, edge, found, subroutine=False):
+    '''
+    add the fusions from `pc` up to `edge` to `found`. returns the targets
+    of the subroutines called on the way
+    '''
+    calls = []
+    while pc <= edge:
+        ins = instructions[read(pc)]
+        if subroutine and ins.name() in RETURNS:
+            break
+        if ins.name() == 'JSR':
+            calls.append(read(pc + 1) | (read(pc + 2) << 8))
+        for pattern in _STARTING.get(ins.name(), ()):
+            addr = last = pc
+            for name in pattern:
+                if addr > edge or instructions[read(addr)].name() != name:
+                    break
+                last = addr
+                addr += instructions[read(addr)].length()
+            else:
+                found.append((pc, last, pattern))
+                pc = addr
+                break
+        else:
+            pc += ins.length()
+    return calls
+
+
+def find_fusions(instructions, read, head, edge):
+    '''
+    [(pc, last pc, pattern)] of the FUSIONS in the loop from `head` to the
+    jump back at `edge` and in the subroutines it calls, not overlapping.
+    read(addr) reads code bytes
+    '''
+    if edge - head > MAX_LOOP:
+        return []
+    found = []
+    for target in _scan(instructions, read, head, edge, found):
+        if target >= 0x8000 and not head <= target <= edge:
+            _scan(instructions, read, target, min(target + MAX_LOOP, 0xFFF0), found, True)
+    return found
@@ -0,0 +1,64 @@
+import sys
+import glob
+import time
+from collections import Counter
+from console import Console
+
+
+def run(path, frames, fuse):
+    '''
+    (seconds, cpu) running `frames` frames of the rom
+    '''
+    console = Console(path)
+    cpu = console.get_cpu()
+    cpu.fuse = fuse
+    start = time.perf_counter()
+    for _ in range(frames):
+        console.run_frame()
+    return time.perf_counter() - start, cpu
+
+
+def best(path, frames, repeat):
+    '''
+    (plain seconds, fused seconds, fused cpu), the best of `repeat` runs
+    each. The runs alternate so a change of the machine's load slows both
+    '''
+    plain = fused = None
+    for _ in range(repeat):
+        res = run(path, frames, False)
+        plain = res if plain is None or res[0] < plain[0] else plain
+        res = run(path, frames, True)
+        fused = res if fused is None or res[0] < fused[0] else fused
+    return plain[0], fused[0], fused[1]
+
+
+def main():
+    '''
+    python fusion_report.py [frames] [repeat]
+
+    runs every rom in roms/ with and without fusion and prints which
+    fusions fired and the time saved
+    '''
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    for path in sorted(glob.glob('roms/*.nes')):
+        try:
+            Console(path)
+        except AssertionError as e:
+            # an unsupported mapper
+            print('{}: skipped, {}'.format(path, e))
+            continue
+        plain, fused, cpu = best(path, frames, repeat)
+        fired = Counter()
+        sites = Counter()
+        for fusion in cpu.fusions():
+            fired[fusion.name()] += fusion.fired()
+            sites[fusion.name()] += 1
+        print('{}: {} frames {:.2f}s -> {:.2f}s, saved {:.1f}%'.format(
+            path, frames, plain, fused, 100 * (plain - fused) / plain))
+        for name, count in fired.most_common():
+            print('    {:<14} {:3} sites {:10} fired'.format(name, sites[name], count))
+
+
+if __name__ == "__main__":
+    main()
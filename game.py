@@ -5,7 +5,7 @@ from pygame.locals import QUIT
 
 class Game:
 
-    def __init__(self, width, height, caption):
+    def __init__(self, width, height, caption, scheduler=None):
         pygame.init()
         # pygame.display.init()
         # pygame.font.init()
@@ -18,6 +18,8 @@ class Game:
         self.prev_update = pygame.time.get_ticks()
         self.prev_render = pygame.time.get_ticks()
         self.entities = []
+        # with a FrameScheduler every update is one frame at its rate
+        self.scheduler = scheduler
 
     def _update_time_delta(self):
         now_update = pygame.time.get_ticks()
@@ -31,8 +33,14 @@ class Game:
     def run(self):
         while self.running:
             self.process_event()
-            self.update(self._update_time_delta())
-            self.render()
+            if self.scheduler is None:
+                self.update(self._update_time_delta())
+                self.render()
+            else:
+                render = self.scheduler.tick()
+                self.update(self.scheduler.frame_ms)
+                if render:
+                    self.render()
         pygame.quit()
         sys.exit()
 
@@ -0,0 +1,98 @@
+import os
+import sys
+import glob
+import time
+import zlib
+from console import Console
+
+
+GOLDEN_DIR = 'golden'
+FRAMES = 600
+
+
+def golden_path(rom):
+    return os.path.join(GOLDEN_DIR, os.path.splitext(os.path.basename(rom))[0] + '.txt')
+
+
+def run(console, frames):
+    '''
+    (frame hashes, seconds) of the next `frames` frames of a console
+    '''
+    hashes = []
+    start = time.perf_counter()
+    for _ in range(frames):
+        console.run_frame()
+        hashes.append(zlib.crc32(console.frame()))
+    return hashes, time.perf_counter() - start
+
+
+def read_golden(path):
+    with open(path) as fin:
+        return [int(line.split()[1], 16) for line in fin if line.strip()]
+
+
+def write_golden(path, hashes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fout:
+        for frame, crc in enumerate(hashes, 1):
+            fout.write('{} {:08x}\n'.format(frame, crc))
+
+
+def first_difference(want, got):
+    '''
+    index of the first hash differing, None if the common frames match
+    '''
+    for i, (a, b) in enumerate(zip(want, got)):
+        if a != b:
+            return i
+    return None
+
+
+def main():
+    '''
+    python golden_test.py [--update] [frames] [rom ...]
+
+    runs every rom in roms/ (or the ones given) for `frames` frames and
+    compares the crc32 of every frame with golden/<rom>.txt; --update
+    writes the golden files instead
+    '''
+    args = sys.argv[1:]
+    update = '--update' in args
+    args = [arg for arg in args if arg != '--update']
+    frames = int(args.pop(0)) if args and args[0].isdigit() else FRAMES
+    roms = args or sorted(glob.glob('roms/*.nes'))
+    failed = 0
+    for rom in roms:
+        try:
+            console = Console(rom)
+        except AssertionError as e:
+            # an unsupported mapper
+            print('{}: skipped, {}'.format(rom, e))
+            continue
+        hashes, elapsed = run(console, frames)
+        path = golden_path(rom)
+        speed = '{} frames, {:.1f} fps'.format(frames, frames / elapsed)
+        if update:
+            write_golden(path, hashes)
+            print('{}: {} written, {}'.format(rom, path, speed))
+            continue
+        if not os.path.exists(path):
+            print('{}: no {}, run with --update'.format(rom, path))
+            failed += 1
+            continue
+        want = read_golden(path)
+        i = first_difference(want, hashes)
+        if i is not None:
+            print('{}: frame {} differs, {:08x} != {:08x}'.format(rom, i + 1, hashes[i], want[i]))
+            failed += 1
+        elif len(want) < frames:
+            print('{}: golden has {} frames only'.format(rom, len(want)))
+            failed += 1
+        else:
+            print('{}: ok, {}'.format(rom, speed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Idle loops: short straight runs of instructions that only read memory,
+# ending with a branch or JMP back to their first instruction, e.g.
+#
+#     wait: BIT $2002        wait: LDA $0B        wait: JMP wait
+#           BPL wait               BEQ wait
+#
+# Once such a loop gets back to its head twice in a row with the same
+# registers and PPU status, nothing changes until the next PPU event, so
+# the CPU may skip whole iterations up to it.
+
+
+# instructions which read memory at most and change nothing but registers
+PURE = {
+    'LDA', 'LDX', 'LDY', 'BIT', 'CMP', 'CPX', 'CPY', 'AND', 'ORA', 'EOR',
+    'ADC', 'SBC', 'NOP', 'CLC', 'SEC', 'CLV', 'CLD', 'SED', 'TAX', 'TAY',
+    'TXA', 'TYA', 'TSX'
+}
+
+PURE_MODES = {'Implied', 'Immediate', 'ZeroPage', 'Absolute'}
+
+BACK_EDGES = {'BPL', 'BMI', 'BVC', 'BVS', 'BCC', 'BCS', 'BNE', 'BEQ', 'JMP'}
+
+# at most this many instructions per loop
+MAX_BODY = 6
+
+
+class IdleLoop:
+
+    __slots__ = ('head', 'length', 'status', 'cycle', 'snapshot', 'deadline')
+
+    def __init__(self, head, length, status):
+        self.head = head
+        # cycles of one iteration, one more if the branch crosses a page
+        self.length = length
+        # the PPURegister polled by the loop, or None
+        self.status = status
+        # cycle, registers and ppu deadline at the last arrival at head
+        self.cycle = None
+        self.snapshot = None
+        self.deadline = None
+
+
+def analyse(instructions, read, head, edge, status_chip):
+    '''
+    IdleLoop for the loop from `head` to the jump back at `edge`, or None.
+    read(addr) reads code bytes, status_chip(addr) gives the PPURegister
+    decoding a status register address (None if there is none)
+    '''
+    pc = head
+    length = 0
+    status = None
+    for _ in range(MAX_BODY):
+        ins = instructions[read(pc)]
+        name = ins.name()
+        mode = ins.addr_mode().name
+        length += ins.cycle()
+        if pc == edge:
+            if name not in BACK_EDGES:
+                return None
+            if mode == 'Relative':
+                offset = read(pc + 1)
+                target = (pc + 2 + offset - (256 if offset >= 0x80 else 0)) & 0xFFFF
+                length += 1
+            elif mode == 'Absolute':
+                target = read(pc + 1) | (read(pc + 2) << 8)
+            else:
+                return None
+            return IdleLoop(head, length, status) if target == head else None
+        if name not in PURE or mode not in PURE_MODES:
+            return None
+        if mode == 'ZeroPage':
+            addr = read(pc + 1)
+        elif mode == 'Absolute':
+            addr = read(pc + 1) | (read(pc + 2) << 8)
+        else:
+            addr = None
+        if addr is not None and 0x2000 <= addr < 0x8000:
+            # besides RAM and ROM only the PPU status register may be read,
+            # reading it twice without a PPU event in between gives the same
+            if addr >= 0x4000 or addr & 7 != 2:
+                return None
+            chip = status_chip(addr)
+            if chip is None or status not in (None, chip):
+                return None
+            status = chip
+        pc += ins.length()
+        if pc > edge:
+            return None
+    return None
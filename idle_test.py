@@ -0,0 +1,56 @@
+import sys
+from bus import Bus
+from chip import PGRRom, Ram
+from cpu import Cpu6502, Engine
+
+
+CYCLES = 100000
+
+# roms of a single idle loop at $8000, the reset vector
+LOOPS = {
+    # wait: LDA $10 / BEQ wait
+    'branch': bytes((0xA5, 0x10, 0xF0, 0xFC)),
+    # wait: JMP wait
+    'self jump': bytes((0x4C, 0x00, 0x80)),
+}
+
+
+def run(code, engine, idle_skip):
+    '''
+    (registers, cycle, idle cycles) after running the code for CYCLES cycles
+    '''
+    prg = bytearray(0x4000)
+    prg[:len(code)] = code
+    prg[0x3FFC:0x3FFE] = (0x00, 0x80)
+    pgr = PGRRom()
+    pgr.load(bytes(prg))
+    bus = Bus()
+    bus.connect(pgr)
+    bus.connect(Ram())
+    cpu = Cpu6502(bus, engine)
+    cpu.idle_skip = idle_skip
+    cpu.reset()
+    cpu.run_cycles(CYCLES)
+    return cpu.registers(), cpu.cycle(), cpu.idle_cycles
+
+
+def main():
+    '''
+    python idle_test.py
+
+    every engine must skip most of the cycles of an idle loop and end in
+    the same state as without skipping
+    '''
+    failed = 0
+    for name, code in LOOPS.items():
+        for engine in Engine:
+            registers, cycle, idle = run(code, engine, True)
+            ok = idle > CYCLES // 2 and run(code, engine, False)[:2] == (registers, cycle)
+            print('{:<10} {:<12} {} idle cycles {}'.format(name, engine.name, idle, 'ok' if ok else 'FAILED'))
+            failed += not ok
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
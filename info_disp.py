@@ -1,17 +1,23 @@
 import entity
 import pygame
+from scheduler import NTSC_FPS
 
 
 class FpsInfo(entity.Entity):
 
     LAST = 10
 
-    def __init__(self):
+    def __init__(self, scheduler=None):
         super().__init__()
         self.font = pygame.font.SysFont('consola', 18)
         self.render_cnt = 0
         self.start_time = pygame.time.get_ticks()
         self.fps = 0
+        self.scheduler = scheduler
+        self.emulated_fps = 0
+        self.skipped = 0
+        self._last_emulated = 0
+        self._last_skipped = 0
 
     def on_update(self, delta):
         pass
@@ -21,10 +27,25 @@ class FpsInfo(entity.Entity):
             now = pygame.time.get_ticks()
             self.render_cnt = 0
             self.fps = 1000 * FpsInfo.LAST / (now - self.start_time)
+            if self.scheduler is not None:
+                # frames run forward, none while paused or rewinding
+                forward = self.scheduler.emulated - self._last_emulated
+                self.emulated_fps = 1000 * forward / (now - self.start_time)
+                self.skipped = self.scheduler.skipped - self._last_skipped
+                self._last_emulated = self.scheduler.emulated
+                self._last_skipped = self.scheduler.skipped
             self.start_time = now
         self.render_cnt += 1
         hello = self.font.render('FPS: {:.2f}'.format(self.fps), True, (255, 0, 0))
         screen.blit(hello, (700, self.font.get_linesize()))
+        if self.scheduler is not None:
+            emu = self.font.render('EMU: {:.2f}'.format(self.emulated_fps), True, (255, 0, 0))
+            screen.blit(emu, (700, self.font.get_linesize() * 2))
+            skip = self.font.render('SKIP: {}'.format(self.skipped), True, (255, 0, 0))
+            screen.blit(skip, (700, self.font.get_linesize() * 3))
+            # speed of the frames run forward relative to a real console
+            speed = self.font.render('x{:.2f}'.format(self.emulated_fps / NTSC_FPS), True, (255, 0, 0))
+            screen.blit(speed, (700, self.font.get_linesize() * 4))
 
     def on_event(self, event):
         pass
@@ -1,34 +1,179 @@
+import sys
+import hashlib
+from array import array
+
+
+# parsed traces are cached next to the text as <path>.cache
+CACHE_MAGIC = b'NESTRACE'
+CACHE_VERSION = 1
+
+
+def pack(pc, a, x, y, p, sp):
+    '''
+    cpu registers as one int, comparable with Log.states
+    '''
+    return (pc << 40) | (a << 32) | (x << 24) | (y << 16) | (p << 8) | sp
+
+
+def unpack(state):
+    '''
+    (pc, a, x, y, p, sp) of a packed state
+    '''
+    return (state >> 40, (state >> 32) & 0xFF, (state >> 24) & 0xFF,
+            (state >> 16) & 0xFF, (state >> 8) & 0xFF, state & 0xFF)
+
+
+def _parse(text):
+    '''
+    (states, cycles, offsets) columns of a nestest trace
+    '''
+    states = array('Q')
+    cycles = array('Q')
+    offsets = array('Q')
+    pos = 0
+    for line in text.splitlines(True):
+        fields = line.split()
+        if fields:
+            last = fields[-7:]
+            states.append(pack(
+                int(fields[0], 16),
+                int(last[0][2:], 16),
+                int(last[1][2:], 16),
+                int(last[2][2:], 16),
+                int(last[3][2:], 16),
+                int(last[4][3:], 16)))
+            cycles.append(int(last[6][4:]))
+            offsets.append(pos)
+        pos += len(line)
+    return states, cycles, offsets
+
+
+def _load_cache(path, digest):
+    try:
+        with open(path, 'rb') as fin:
+            data = fin.read()
+    except OSError:
+        return None
+    head = len(CACHE_MAGIC) + 2 + len(digest) + 8
+    if (len(data) < head or not data.startswith(CACHE_MAGIC)
+            or data[len(CACHE_MAGIC):len(CACHE_MAGIC) + 2] != CACHE_VERSION.to_bytes(2, 'little')
+            or data[len(CACHE_MAGIC) + 2:head - 8] != digest):
+        return None
+    count = int.from_bytes(data[head - 8:head], 'little')
+    columns = []
+    pos = head
+    for _ in range(3):
+        column = array('Q')
+        column.frombytes(data[pos:pos + count * 8])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        columns.append(column)
+        pos += count * 8
+    if pos != len(data):
+        return None
+    return columns
+
+
+def _save_cache(path, digest, columns):
+    parts = [CACHE_MAGIC, CACHE_VERSION.to_bytes(2, 'little'), digest, len(columns[0]).to_bytes(8, 'little')]
+    for column in columns:
+        if sys.byteorder != 'little':
+            column = array('Q', column)
+            column.byteswap()
+        parts.append(column.tobytes())
+    try:
+        with open(path, 'wb') as fout:
+            fout.write(b''.join(parts))
+    except OSError:
+        pass
 
 
 class Log:
+    '''
+    a nestest trace as parallel columns: states[i] is the pack()ed registers
+    and cycles[i] the cycle count before the i-th instruction. the parsed
+    columns are cached in a sidecar file keyed by the hash of the text
+    '''
 
-    def __init__(self):
-        self.lines = []
-        with open('log.txt', 'r') as fin:
-            for line in fin:
-                line = line.split()
-                last = line[-7:]
-                status = {
-                    'PC': int(line[0], 16),
-                    'A': int(last[0][2:], 16),
-                    'X': int(last[1][2:], 16),
-                    'Y': int(last[2][2:], 16),
-                    'F': int(last[3][2:], 16),
-                    'SP': int(last[4][3:], 16),
-                    'CYC': int(last[6][4:])
-                }
-                self.lines.append(status)
+    def __init__(self, path='log.txt', cache=True):
+        self.path = path
+        with open(path, 'rb') as fin:
+            raw = fin.read()
+        digest = hashlib.sha1(raw).digest()
+        cache_path = path + '.cache'
+        columns = _load_cache(cache_path, digest) if cache else None
+        if columns is None:
+            columns = _parse(raw.decode('ascii'))
+            if cache:
+                _save_cache(cache_path, digest, columns)
+        self.states, self.cycles, self._offsets = columns
+        self._raw = raw
         self.now_pos = 0
 
+    def __len__(self):
+        return len(self.states)
+
+    def line(self, i):
+        '''
+        the text of the i-th line
+        '''
+        start = self._offsets[i]
+        end = self._offsets[i + 1] if i + 1 < len(self._offsets) else len(self._raw)
+        return self._raw[start:end].decode('ascii').rstrip()
+
+    def status(self, i):
+        pc, a, x, y, p, sp = unpack(self.states[i])
+        return {'PC': pc, 'A': a, 'X': x, 'Y': y, 'F': p, 'SP': sp, 'CYC': self.cycles[i]}
+
+    def compare(self, run, registers, cycle, skip=False):
+        '''
+        run the cpu along the trace: run() executes the next instruction,
+        registers() and cycle() give the state to check before each one.
+        returns (lines passed, None) or, at the first divergence,
+        (lines passed, report). Only with `skip`, for a run() that may
+        execute several instructions, the lines run past are not checked
+        '''
+        states = self.states
+        cycles = self.cycles
+        count = len(states)
+        i = 0
+        while i < count:
+            state = pack(*registers())
+            now = cycle()
+            if state != states[i] or now != cycles[i]:
+                return i, self.report(i, state, now)
+            run()
+            i += 1
+            if skip:
+                now = cycle()
+                while i < count and cycles[i] < now:
+                    i += 1
+        return i, None
+
+    def report(self, i, state, cycle, context=5):
+        out = ['diverged at line {}'.format(i + 1)]
+        for j in range(max(0, i - context), i):
+            out.append('     {}'.format(self.line(j)))
+        out.append('want {}'.format(self.line(i)))
+        pc, a, x, y, p, sp = unpack(state)
+        got = '{:04X}{}A:{:02X} X:{:02X} Y:{:02X} P:{:02X} SP:{:02X} CYC:{}'.format(
+            pc, ' ' * 44, a, x, y, p, sp, cycle)
+        out.append('got  {}'.format(got))
+        fields = zip(('PC', 'A', 'X', 'Y', 'P', 'SP'), unpack(self.states[i]), unpack(state))
+        diff = ['{} {:X} != {:X}'.format(name, want, have) for name, want, have in fields if want != have]
+        if self.cycles[i] != cycle:
+            diff.append('CYC {} != {}'.format(self.cycles[i], cycle))
+        out.append('     ' + ', '.join(diff))
+        return '\n'.join(out)
+
+    # step by step interface
+
     def check(self, log):
-        for k, v in log.items():
-            if self.lines[self.now_pos][k] != v:
-                return False
-        return True
+        return self.log() == log
 
     def log(self):
-        return self.lines[self.now_pos]
+        return self.status(self.now_pos)
 
     def next(self):
         self.now_pos += 1
-        return self.now_pos == len(self.lines)
+        return self.now_pos == len(self.states)
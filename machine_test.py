@@ -1,13 +1,19 @@
+import sys
+import time
 from chip import *
-from cpu import Cpu6502
+from cpu import Cpu6502, Engine
 from ppu import Ppu
 from bus import Bus
 from nes import Nes
 from log import Log
-from collections import OrderedDict
 
 
-def main():
+# Engine.Block runs the trace this many cycles at a time, blocks only run
+# from run_cycles and when they end inside the slice
+BLOCK_SLICE = 256
+
+
+def main(engine=Engine.Interpreter):
     _ppu_bus = Bus()
     _ppu_pattern = PatternTable()
     # _ppu_pattern.load(nes.chr)
@@ -32,28 +38,28 @@ def main():
     bus.connect(pau_exp)
     bus.connect(ppu_reg)
 
-    cpu = Cpu6502(bus)
+    cpu = Cpu6502(bus, engine)
     cpu.test_mode()
 
+    start = time.perf_counter()
     real_log = Log()
-    n = 0
-    while True:
-        n += 1
-        log = cpu.log()
-        if not real_log.check(log):
-            # print('F: {}'.format(OrderedDict(log)))
-            # print('T: {}'.format(OrderedDict(real_log.log())))
-            # print('{} Addr: {}, Data: {}'.format(n, cpu._addr, cpu._data))
-            break
-        else:
-            pass
-            # print('T: {}'.format(OrderedDict(log)))
-        cpu.run()
-        end = real_log.next()
-        if end:
-            break
+    if engine == Engine.Block:
+        # every block is compiled on its first entry, the lines inside the
+        # blocks run in a slice are not checked
+        cpu.hot_visits = 1
+        last = real_log.cycles[-1]
+
+        def run():
+            cpu.run_cycles(max(1, min(BLOCK_SLICE, last - cpu.cycle())))
+        n, report = real_log.compare(run, cpu.registers, cpu.cycle, True)
+    else:
+        n, report = real_log.compare(cpu.run, cpu.registers, cpu.cycle)
+    elapsed = time.perf_counter() - start
+    if report is not None:
+        print(report)
     print('{} ins passed'.format(n))
+    print('{}: {:.0f} ins/s'.format(engine.name, n / elapsed))
 
 
 if __name__ == "__main__":
-    main()
+    main(Engine[sys.argv[1]] if len(sys.argv) > 1 else Engine.Interpreter)
@@ -0,0 +1,196 @@
+import sys
+import struct
+import time
+import zlib
+from array import array
+from chip import BUTTON_A, BUTTON_B, BUTTON_START, BUTTON_RIGHT
+from console import Console
+from savestate import snapshot, restore
+
+
+MAGIC = b'NESMOVIE'
+VERSION = 1
+
+# magic, version, crc32 of the PRG, frames, size of the save state the
+# movie starts from (0 when it starts at power on). The state follows,
+# then the buttons of both controllers for every frame, two bytes each,
+# and the crc32 of the machine state after every frame
+HEADER = struct.Struct('<8sHIII')
+
+
+def state_hash(console):
+    return zlib.crc32(snapshot(console))
+
+
+class Movie:
+    '''
+    the input of every frame played on a rom, and the hash of the machine
+    state after it
+    '''
+
+    def __init__(self, rom_crc, start=b''):
+        self.rom_crc = rom_crc
+        self.start = start
+        self.inputs = bytearray()
+        self.hashes = array('I')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def buttons(self, frame):
+        '''
+        (port 1, port 2) buttons of a frame
+        '''
+        return self.inputs[frame * 2], self.inputs[frame * 2 + 1]
+
+    def save(self, path):
+        hashes = array('I', self.hashes)
+        if sys.byteorder != 'little':
+            hashes.byteswap()
+        with open(path, 'wb') as fout:
+            fout.write(HEADER.pack(MAGIC, VERSION, self.rom_crc, len(self), len(self.start)))
+            fout.write(self.start)
+            fout.write(self.inputs)
+            fout.write(hashes.tobytes())
+
+
+def load(path):
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    if len(data) < HEADER.size or not data.startswith(MAGIC):
+        raise RuntimeError('Not a movie')
+    magic, version, rom_crc, frames, start_size = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise RuntimeError('Unsupported movie version: {}'.format(version))
+    if len(data) != HEADER.size + start_size + frames * 6:
+        raise RuntimeError('Truncated movie')
+    pos = HEADER.size
+    movie = Movie(rom_crc, data[pos:pos + start_size])
+    pos += start_size
+    movie.inputs[:] = data[pos:pos + frames * 2]
+    pos += frames * 2
+    movie.hashes.frombytes(data[pos:])
+    if sys.byteorder != 'little':
+        movie.hashes.byteswap()
+    return movie
+
+
+class MovieRecorder:
+    '''
+    runs frames of a console with the given buttons and records them.
+    with from_state the movie starts from the current state, otherwise the
+    console must be just powered on. The console may be rewound or a state
+    loaded between frames: the movie is cut back to the frame the console
+    is at, or started over from its state when that frame is not in it
+    '''
+
+    def __init__(self, console, from_state=False):
+        self._console = console
+        self.movie = Movie(console.rom_crc(), snapshot(console) if from_state else b'')
+        self._first = console.frames
+        self._start_hash = state_hash(console)
+
+    def follow(self):
+        console = self._console
+        movie = self.movie
+        now = state_hash(console)
+        if now == (movie.hashes[-1] if len(movie) else self._start_hash):
+            return
+        frame = console.frames - self._first
+        if 0 < frame <= len(movie) and movie.hashes[frame - 1] == now or \
+                frame == 0 and now == self._start_hash:
+            del movie.inputs[frame * 2:]
+            del movie.hashes[frame:]
+        else:
+            self.__init__(console, from_state=True)
+
+    def frame(self, port1, port2=0):
+        console = self._console
+        self.follow()
+        console.get_controller().buttons[:] = (port1, port2)
+        console.run_frame()
+        self.movie.inputs += bytes((port1, port2))
+        self.movie.hashes.append(state_hash(console))
+
+    def save(self, path):
+        self.follow()
+        self.movie.save(path)
+
+
+def play(console, movie, check=True):
+    '''
+    play a movie on a console just powered on. returns the first frame
+    whose state hash differs from the recorded one, None if all match or
+    check is False
+    '''
+    if movie.rom_crc != console.rom_crc():
+        raise RuntimeError('Movie of another rom')
+    if movie.start:
+        restore(console, movie.start)
+    buttons = console.get_controller().buttons
+    inputs = movie.inputs
+    hashes = movie.hashes
+    run_frame = console.run_frame
+    for frame in range(len(hashes)):
+        buttons[0] = inputs[frame * 2]
+        buttons[1] = inputs[frame * 2 + 1]
+        run_frame()
+        if check and state_hash(console) != hashes[frame]:
+            return frame
+    return None
+
+
+def walk_right(frame):
+    '''
+    port 1 buttons of a scripted run: press Start after a second, then
+    hold right with B and jump every second
+    '''
+    if frame < 60:
+        return 0
+    if frame < 70:
+        return BUTTON_START
+    if frame < 180:
+        return 0
+    buttons = BUTTON_RIGHT | BUTTON_B
+    if frame % 60 < 20:
+        buttons |= BUTTON_A
+    return buttons
+
+
+def main():
+    '''
+    python movie.py record rom out.movie frames
+    python movie.py replay rom in.movie [repeat]
+
+    record plays the walk_right script; replay plays a movie back as fast
+    as possible and checks every frame against the recorded state hashes
+    '''
+    command = sys.argv[1]
+    if command == 'record':
+        console = Console(sys.argv[2])
+        recorder = MovieRecorder(console)
+        for frame in range(int(sys.argv[4])):
+            recorder.frame(walk_right(frame))
+        recorder.movie.save(sys.argv[3])
+        print('{} frames recorded'.format(len(recorder.movie)))
+    elif command == 'replay':
+        movie = load(sys.argv[3])
+        repeat = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        best = float('inf')
+        for _ in range(repeat):
+            console = Console(sys.argv[2])
+            start = time.perf_counter()
+            frame = play(console, movie)
+            best = min(best, time.perf_counter() - start)
+            if frame is not None:
+                print('{}: diverged at frame {} of {}'.format(sys.argv[3], frame, len(movie)))
+                sys.exit(1)
+        print('{}: {} frames in {:.2f}s, {:.1f} fps, deterministic'.format(
+            sys.argv[3], len(movie), best, len(movie) / best))
+    else:
+        print(main.__doc__)
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
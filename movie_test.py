@@ -0,0 +1,107 @@
+import os
+import sys
+import tempfile
+from console import Console
+from cpu import Engine
+from movie import MovieRecorder, load, play, state_hash, walk_right
+from rewind import Rewind
+from savestate import snapshot, restore
+
+
+def replays(path, recorder, console):
+    '''
+    whether the saved movie plays back to the state the console is at
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'test.movie')
+        recorder.save(out)
+        movie = load(out)
+    player = Console(path)
+    return play(player, movie) is None and state_hash(player) == state_hash(console)
+
+
+def rewound(path, frames):
+    '''
+    record, rewind a few seconds as visual.py does while Backspace is held
+    and record on with other buttons
+    '''
+    console = Console(path)
+    recorder = MovieRecorder(console)
+    rewind = Rewind(console)
+    for frame in range(frames):
+        recorder.frame(walk_right(frame))
+        rewind.capture()
+    for _ in range(frames // 8):
+        rewind.back()
+    for frame in range(frames // 2):
+        recorder.frame(walk_right(frame + 30))
+        rewind.capture()
+    return replays(path, recorder, console) and len(recorder.movie) == console.frames
+
+
+def loaded(path, frames):
+    '''
+    record, load a state saved earlier in the movie, record on, then load
+    a state of another run past the movie's end: the movie starts over
+    from it
+    '''
+    console = Console(path)
+    recorder = MovieRecorder(console)
+    for frame in range(frames):
+        recorder.frame(walk_right(frame))
+        if frame == frames // 2:
+            state = snapshot(console)
+    restore(console, state)
+    for frame in range(frames // 2):
+        recorder.frame(walk_right(frame + 30))
+    ok = replays(path, recorder, console) and len(recorder.movie) == console.frames
+    other = Console(path)
+    for frame in range(frames * 2):
+        other.get_controller().buttons[0] = walk_right(frame + 7)
+        other.run_frame()
+    restore(console, snapshot(other))
+    for frame in range(frames // 2):
+        recorder.frame(walk_right(frame))
+    return ok and replays(path, recorder, console) and len(recorder.movie) == frames // 2
+
+
+def engines(path, frames):
+    '''
+    record on one engine and replay on every engine, with fusion too
+    '''
+    console = Console(path, Engine.Dispatch)
+    recorder = MovieRecorder(console)
+    for frame in range(frames):
+        recorder.frame(walk_right(frame))
+    ok = True
+    for engine in Engine:
+        for fuse in (False, True):
+            player = Console(path, engine)
+            player.get_cpu().fuse = fuse
+            ok = ok and play(player, recorder.movie) is None
+    return ok
+
+
+def main():
+    '''
+    python movie_test.py [frames] [rom ...]
+
+    movies recorded across rewinds and save state loads must replay to
+    the same state, movies recorded on one engine on every engine. mario
+    leaves stale flags behind that differ between the engines
+    '''
+    args = sys.argv[1:]
+    frames = int(args.pop(0)) if args and args[0].isdigit() else 300
+    roms = args or ['roms/tank.nes', 'roms/mario.nes']
+    failed = 0
+    for path in roms:
+        for test in (rewound, loaded, engines):
+            ok = test(path, frames)
+            print('{}: {:<8} {}'.format(path, test.__name__, 'ok' if ok else 'FAILED'))
+            failed += not ok
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,132 +1,210 @@
 import random
+import numpy as np
 from bus import Bus
 from chip import PPURegister
 from palettes import PALETTES
-import pygame.image as Image
+from tracer import TRACE, PPU_VBLANK_SET, PPU_VBLANK_CLEAR, PPU_NMI
+
+
+DOTS_PER_LINE = 340
+FRAME_DOTS = DOTS_PER_LINE * 261
+VBLANK_DOT = DOTS_PER_LINE * 240
+
+# nes color -> rgb
+RGB_LUT = np.array(PALETTES, dtype=np.uint8)
+# per background tile: attribute byte and bit shift of its 2-bit palette
+_TILE_ROW, _TILE_COL = np.mgrid[0:30, 0:32]
+ATTR_INDEX = (_TILE_ROW // 4) * 8 + _TILE_COL // 4
+ATTR_SHIFT = (_TILE_ROW % 4 // 2) * 4 + (_TILE_COL % 4 // 2) * 2
+
+
+def to_rgb(indices):
+    '''
+    (..., 3) uint8 rgb array of an array of nes colors
+    '''
+    return np.take(RGB_LUT, indices, axis=0)
+
+
+def decode_tiles(chr_data):
+    '''
+    (512, 8, 8) array of 2-bit pixels for the 512 tiles of the pattern tables
+    '''
+    planes = np.frombuffer(chr_data, dtype=np.uint8).reshape(-1, 2, 8)
+    bits = np.unpackbits(planes, axis=2).reshape(-1, 2, 8, 8)
+    return bits[:, 0] | (bits[:, 1] << 1)
+
+
+class TileCache:
+    '''
+    all 512 tiles of a PatternTable decoded once, re-decoded tile by tile
+    after CHR writes or a reload
+    '''
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+        self._tiles = decode_tiles(pattern.memory())
+        self._dirty = set()
+        self.version = 0 # bumped whenever a tile changes
+        pattern.set_on_change(self.invalidate)
+
+    def invalidate(self, start, end):
+        self._dirty.update(range(start >> 4, ((end - 1) >> 4) + 1))
+
+    def tiles(self):
+        '''
+        (512, 8, 8) array of 2-bit pixels, tile 256 is the first of $1000
+        '''
+        if self._dirty:
+            data = self._pattern.memory()
+            if len(self._dirty) == 512:
+                self._tiles = decode_tiles(data)
+            else:
+                for tile in self._dirty:
+                    self._tiles[tile] = decode_tiles(data[tile * 16:tile * 16 + 16])[0]
+            self._dirty.clear()
+            self.version += 1
+        return self._tiles
 
 
 class Ppu:
 
     def __init__(self, bus: Bus):
         self._reg = PPURegister(bus)
-        self._row = 0
-        self._col = 0
-        self._req_nmi = lambda: print('Should set requeset nmi function')
+        self._reg.set_sync(self._sync_now)
+        self._dot = 0 # row * DOTS_PER_LINE + col
+        self._cycle = 0 # cpu cycle the dot counter is synced to
+        self._clock = None
+        self._req_nmi = lambda: None
+        self._notify_vblank = lambda: None
 
         self._bus = bus
+        self._tile_cache = TileCache(bus.owner(0x0000))
+        self._pattern_version = None
         self._pattern = None
-        self._pattern_bytes = bytearray(256 * 128 * 3)
-        self._fill_pattern()
-        self._prepare_pattern()
-        self._pattern_image = Image.frombuffer(self._pattern_bytes, (256, 128), 'RGB')
 
     def set_request_nmi(self, func):
         self._req_nmi = func
 
+    def set_notify_vblank(self, func):
+        self._notify_vblank = func
+
+    def set_clock(self, func):
+        '''
+        func() gives the current cpu cycle; register accesses sync to it
+        '''
+        self._clock = func
+        self._cycle = func()
+
+    def _sync_now(self):
+        if self._clock is not None:
+            self.sync(self._clock())
+
+    def sync(self, cycle):
+        '''
+        catch up to cpu `cycle` (3 dots per cycle) and return the cpu cycle
+        at which the next vblank set/clear happens
+        '''
+        if cycle > self._cycle:
+            self._advance((cycle - self._cycle) * 3)
+        self._cycle = cycle
+        dot = self._dot
+        if dot < VBLANK_DOT:
+            left = VBLANK_DOT - dot
+        else:
+            left = FRAME_DOTS - dot
+        return cycle + (left + 2) // 3
+
+    def state(self):
+        '''
+        (dot, cpu cycle) followed by the register state, for a save state
+        '''
+        return (self._dot, self._cycle) + self._reg.state()
+
+    def set_state(self, state):
+        self._dot, self._cycle = state[:2]
+        self._reg.set_state(state[2:])
+
     def run(self):
-        # print('PPU: {}, {}'.format(self._row, self._col))
-        self._col += 1
-        if self._col == 340:
-            self._row += 1
-            self._col = 0
-        if self._row == 261:
-            self._row = 0
-            self._col = 0
-            self._reg.status &= 0xEF
-            print('UNSET VBANK')
-            # print(self._reg.status)
-            # input('WAITING...')
-        if self._row == 240 and self._col == 0:
-            self._reg.status |= (1 << 7)
-            print('Set VBANK...')
-            # print(self._reg.status)
-            # input('WAITING...')
-            if (self._reg.ctrl >> 7 & 1) == 1:
-                self._req_nmi()
-        # print('PPU: {}, {}'.format(self._row, self._col))
-
-    def _prepare_pattern(self):
-        pos = 0
-        for row in range(128):
-            for col in range(256):
-                self._pattern_bytes[pos] = PALETTES[self._pattern[col // 128][row][col % 128]][0]
-                pos += 1
-                self._pattern_bytes[pos] = PALETTES[self._pattern[col // 128][row][col % 128]][1]
-                pos += 1
-                self._pattern_bytes[pos] = PALETTES[self._pattern[col // 128][row][col % 128]][2]
-                pos += 1
+        self._advance(1)
+
+    def _advance(self, dots):
+        dot = self._dot
+        while dots > 0:
+            if dot < VBLANK_DOT:
+                step = VBLANK_DOT - dot
+            else:
+                step = FRAME_DOTS - dot
+            if dots < step:
+                dot += dots
+                break
+            dots -= step
+            dot += step
+            if dot == FRAME_DOTS:
+                dot = 0
+                self._end_vblank()
+            else:
+                self._start_vblank()
+        self._dot = dot
+
+    def _end_vblank(self):
+        self._reg.status &= 0xEF
+        if TRACE.mask & PPU_VBLANK_CLEAR:
+            TRACE.emit(PPU_VBLANK_CLEAR, self._reg.status)
+
+    def _start_vblank(self):
+        self._reg.status |= (1 << 7)
+        if TRACE.mask & PPU_VBLANK_SET:
+            TRACE.emit(PPU_VBLANK_SET, self._reg.status)
+        if (self._reg.ctrl >> 7 & 1) == 1:
+            if TRACE.mask & PPU_NMI:
+                TRACE.emit(PPU_NMI, self._reg.ctrl)
+            self._req_nmi()
+        self._notify_vblank()
 
     def get_register(self):
         return self._reg
 
-    def get_pattern_image(self):
-        return self._pattern_image
-
-    def _fill_pattern(self):
-        left = [[0] * 128 for _ in range(128)]
-        right = [[0] * 128 for _ in range(128)]
-
-        self._pattern = [
-            left,
-            right
-        ]
-        for t in [0x0000, 0x1000]:
-            now_row = 0
-            now_col = 0
-            for addr in range(t, t + 0x1000, 16):
-                for row in range(8):
-                    lo = self._bus.read(addr + row)
-                    hi = self._bus.read(addr + row + 8)
-                    for col in range(8):
-                        this_index = ((lo >> (7 - col) & 1) | ((hi >> (7 - col) & 1) << 1))
-                        self._pattern[t // 0x1000][now_row * 8 + row][now_col * 8 + col] = this_index
-                        # self._pattern[t // 0x1000][now_row * 8 + row][now_col * 8 + col] = 1
-                now_col += 1
-                if now_col == 16:
-                    now_col = 0
-                    now_row += 1
-
-    def get_palettes_image(self):
-        addr_start = 0x3F00
-        buffer = []
-        for i in range(32):
-            color = PALETTES[self._bus.read(addr_start + i)]
-            buffer.extend(color)
-        return Image.fromstring(bytes(buffer), (8, 4), 'RGB')
-
-    def _get_sprite(self, block, index):
-        addr = [0x0000, 0x1000][block] + index * 16
-        pattern = [[0] * 8 for _ in range(8)]
-        for row in range(8):
-            lo = self._bus.read(addr + row)
-            hi = self._bus.read(addr + row + 8)
-            for col in range(8):
-                this_index = ((lo >> (7 - col) & 1) | ((hi >> (7 - col) & 1) << 1))
-                pattern[row][col] = this_index
-        return pattern
-
-    def get_background(self, name_tbl_index):
-        start_addr = [0x2000, 0x2400, 0x2800, 0x2C00][name_tbl_index]
-        buf_pixel_index = [[0] * 256 for _ in range(240)]
+    def get_tile_cache(self):
+        return self._tile_cache
+
+    def pattern_indices(self):
+        '''
+        (128, 256) array of both pattern tables side by side, 16x16 tiles each;
+        pixel values are shown as the first four nes colors
+        '''
+        tiles = self._tile_cache.tiles()
+        if self._pattern_version != self._tile_cache.version:
+            self._pattern_version = self._tile_cache.version
+            self._pattern = tiles.reshape(2, 16, 16, 8, 8).transpose(1, 3, 0, 2, 4).reshape(128, 256)
+        return self._pattern
+
+    def palette_indices(self):
+        '''
+        (4, 8) array of the nes colors in palette ram, as the ppu reads them
+        '''
+        colors = [self._bus.read(0x3F00 + i) & 0x3F for i in range(32)]
+        return np.array(colors, dtype=np.uint8).reshape(4, 8)
+
+    def background_indices(self, name_tbl_index):
+        '''
+        (240, 256) array of nes colors (palette ram values) of a nametable
+        '''
+        base = name_tbl_index * 0x400
+        names = self._bus.owner(0x2000).memory()
+        tiles = self._tile_cache.tiles()
+        palette = np.frombuffer(self._bus.owner(0x3F00).memory(), dtype=np.uint8)
+
+        tile_ids = np.frombuffer(names, dtype=np.uint8, count=960, offset=base).reshape(30, 32)
+        attrs = np.frombuffer(names, dtype=np.uint8, count=64, offset=base + 960)
+        tile_palette = (attrs[ATTR_INDEX] >> ATTR_SHIFT) & 3
+
         sprite_index = (self._reg.ctrl >> 4 & 1)
-        for row in range(30):
-            for col in range(32):
-                block_sprite_index = self._bus.read(start_addr)
-                start_addr += 1
-                pattern = self._get_sprite(sprite_index, block_sprite_index)
-                for r in range(8):
-                    for c in range(8):
-                        attr = self.get_attr(name_tbl_index, row * 8 + r, col * 8 + c)
-                        if pattern[r][c] == 0:
-                            addr = 0x3F00
-                        else:
-                            addr = 0x3F00 + ((attr << 2) | pattern[r][c])
-                        buf_pixel_index[row * 8 + r][col * 8 + c] = self._bus.read(addr) 
-        buffer = []
-        for row in range(240):
-            for col in range(256):
-                buffer.extend(PALETTES[buf_pixel_index[row][col]])
-        return Image.fromstring(bytes(buffer), (256, 240), 'RGB')
+        pixels = tiles[tile_ids.astype(np.intp) + sprite_index * 256]
+        pixels = pixels.transpose(0, 2, 1, 3).reshape(240, 256)
+        pixel_palette = tile_palette.repeat(8, axis=0).repeat(8, axis=1)
+        # colour 0 of every palette is the backdrop at $3F00
+        index = np.where(pixels == 0, 0, (pixel_palette << 2) | pixels)
+        return palette[index] & 0x3F
 
     def get_attr(self, name_tbl_index, pixel_row, pixel_col):
         # TODO
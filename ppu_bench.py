@@ -0,0 +1,50 @@
+import sys
+import time
+from console import Console
+from ppu import to_rgb
+
+
+def mario_ppu(frames=40):
+    '''
+    a ppu whose nametables hold what mario drew in its first `frames` frames
+    '''
+    console = Console('roms/mario.nes')
+    for _ in range(frames):
+        console.run_frame()
+    return console.get_ppu()
+
+
+def frames_per_second(func, repeat):
+    '''
+    best rate of func() over `repeat` one-second-ish rounds
+    '''
+    best = 0
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < 1.0:
+            func()
+            count += 1
+        best = max(best, count / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    ppu = mario_ppu()
+
+    def indices():
+        for i in range(4):
+            ppu.background_indices(i)
+
+    def rgb():
+        for i in range(4):
+            to_rgb(ppu.background_indices(i)).tobytes()
+
+    # one frame is all four nametables, as drawn by visual.Machine.draw_ppu
+    print('{:<20} {:8.1f} fps'.format('background_indices', frames_per_second(indices, repeat)))
+    print('{:<20} {:8.1f} fps'.format('rgb', frames_per_second(rgb, repeat)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import sys
+from array import array
+from bisect import bisect_right
+from console import Console
+
+
+# stack pointer change of the instructions which move it; TXS sets it to X
+SP_DELTA = {
+    'PHA': -1, 'PHP': -1, 'PLA': 1, 'PLP': 1, 'JSR': -2, 'RTS': 2, 'RTI': 3,
+}
+
+JSR = 0x20
+
+
+class Profiler:
+    '''
+    counts executions and cycles per pc and per opcode in flat arrays, and
+    cycles per call stack. Attach it with Cpu6502.set_recorder: each record
+    gives the cycles of the instruction before it.
+    the call stack follows the stack pointer: a JSR or interrupt opens a
+    frame that ends once SP rises above where it was inside, be it by RTS,
+    RTI or by pulling the return address
+    '''
+
+    def __init__(self, cpu):
+        self._cpu = cpu
+        names = [ins.name() for ins in cpu._ins]
+        self._names = names
+        self._delta = [SP_DELTA.get(name, 0) for name in names]
+        self._txs = names.index('TXS')
+        self.pc_count = array('Q', bytes(8 * 0x10000))
+        self.pc_cycles = array('Q', bytes(8 * 0x10000))
+        self.op_count = array('Q', bytes(8 * 0x100))
+        self.op_cycles = array('Q', bytes(8 * 0x100))
+        self.calls = array('Q', bytes(8 * 0x10000))
+        # collapsed stack 'reset;$C5F5;$F4ED' -> cycles spent in its last frame
+        self.stacks = {}
+        # frames: (collapsed stack, sp inside the frame)
+        self._frames = [('reset', 0x100)]
+        self._self = 0
+        self._last = None
+
+    def record(self, pc, opcode, a, x, y, p, sp, cycle):
+        last = self._last
+        self._last = (pc, opcode, x, sp, cycle)
+        if last is None:
+            return
+        last_pc, last_op, last_x, last_sp, last_cycle = last
+        cycles = cycle - last_cycle
+        expected = last_x if last_op == self._txs else (last_sp + self._delta[last_op]) & 0xFF
+        interrupt = sp == (expected - 3) & 0xFF
+        if interrupt:
+            cycles -= 7
+        self.pc_count[last_pc] += 1
+        self.pc_cycles[last_pc] += cycles
+        self.op_count[last_op] += 1
+        self.op_cycles[last_op] += cycles
+        self._self += cycles
+
+        frames = self._frames
+        while len(frames) > 1 and sp > frames[-1][1]:
+            self._close()
+            frames.pop()
+        if last_op == JSR and not interrupt:
+            self.calls[pc] += 1
+            self._open('${:04X}'.format(pc), sp)
+        if interrupt:
+            self._open('nmi', sp)
+            self._self += 7
+
+    def _open(self, label, sp):
+        self._close()
+        self._frames.append((self._frames[-1][0] + ';' + label, sp))
+
+    def _close(self):
+        if self._self:
+            key = self._frames[-1][0]
+            self.stacks[key] = self.stacks.get(key, 0) + self._self
+            self._self = 0
+
+    def finish(self):
+        '''
+        account the cycles of the open frames, call when done recording
+        '''
+        self._close()
+
+    def write_collapsed(self, out):
+        '''
+        one 'frame;frame;frame cycles' line per stack, as read by
+        flamegraph.pl and speedscope
+        '''
+        for key, cycles in sorted(self.stacks.items()):
+            out.write('{} {}\n'.format(key, cycles))
+
+    def routines(self):
+        '''
+        [(start, self cycles, inclusive cycles, calls)] of the routines
+        called with JSR, from the call stacks
+        '''
+        own = {}
+        inclusive = {}
+        for key, cycles in self.stacks.items():
+            labels = key.split(';')
+            own[labels[-1]] = own.get(labels[-1], 0) + cycles
+            for label in set(labels):
+                inclusive[label] = inclusive.get(label, 0) + cycles
+        res = []
+        for start in range(0x10000):
+            if self.calls[start]:
+                label = '${:04X}'.format(start)
+                res.append((start, own.get(label, 0), inclusive.get(label, 0), self.calls[start]))
+        return res
+
+    def routine_of(self, starts, pc):
+        '''
+        the routine a pc belongs to: the closest of the sorted JSR targets
+        `starts` at or below it
+        '''
+        i = bisect_right(starts, pc) - 1
+        return '${:04X}'.format(starts[i]) if i >= 0 else 'reset'
+
+    def _disassemble(self, pc):
+        _, lines = self._cpu.decode(pc, pc + 3)
+        return lines[0] if lines else '${:04X}: ?'.format(pc)
+
+    def report(self, out, top=20):
+        total = sum(self.stacks.values())
+        count = sum(self.pc_count)
+        if not total:
+            out.write('nothing recorded\n')
+            return
+        out.write('{} instructions, {} cycles, {} in interrupt entry\n\n'.format(
+            count, total, total - sum(self.pc_cycles)))
+
+        starts = [addr for addr in range(0x10000) if self.calls[addr]]
+        out.write('top pcs\n{:>10} {:>12} {:>6}  {:<7}  {}\n'.format(
+            'count', 'cycles', '%', 'routine', 'instruction'))
+        pcs = sorted(range(0x10000), key=lambda addr: -self.pc_cycles[addr])[:top]
+        for addr in pcs:
+            if not self.pc_cycles[addr]:
+                break
+            out.write('{:10} {:12} {:6.2f}  {:<7}  {}\n'.format(
+                self.pc_count[addr], self.pc_cycles[addr], 100 * self.pc_cycles[addr] / total,
+                self.routine_of(starts, addr), self._disassemble(addr)))
+
+        out.write('\ntop opcodes\n{:>10} {:>12} {:>6}  {}\n'.format('count', 'cycles', '%', 'opcode'))
+        ops = sorted(range(0x100), key=lambda op: -self.op_cycles[op])[:top]
+        for op in ops:
+            if not self.op_cycles[op]:
+                break
+            ins = self._cpu._ins[op]
+            out.write('{:10} {:12} {:6.2f}  {:02X} {} {}\n'.format(
+                self.op_count[op], self.op_cycles[op], 100 * self.op_cycles[op] / total,
+                op, ins.name(), ins.addr_mode().name))
+
+        out.write('\ntop routines\n{:>10} {:>12} {:>6} {:>12} {:>6}  {}\n'.format(
+            'calls', 'self', '%', 'inclusive', '%', 'entry'))
+        routines = sorted(self.routines(), key=lambda r: -r[2])[:top]
+        for start, own, inclusive, calls in routines:
+            out.write('{:10} {:12} {:6.2f} {:12} {:6.2f}  {}\n'.format(
+                calls, own, 100 * own / total, inclusive, 100 * inclusive / total,
+                self._disassemble(start)))
+
+
+def main():
+    '''
+    python profiler.py rom [frames] [top] [out.folded]
+
+    profiles `frames` frames of a rom, prints the top pcs, opcodes and
+    routines and writes the collapsed stacks for a flamegraph
+    '''
+    path = sys.argv[1]
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    top = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    folded = sys.argv[4] if len(sys.argv) > 4 else None
+    console = Console(path)
+    cpu = console.get_cpu()
+    profiler = Profiler(cpu)
+    cpu.set_recorder(profiler)
+    for _ in range(frames):
+        console.run_frame()
+    cpu.set_recorder(None)
+    profiler.finish()
+    profiler.report(sys.stdout, top)
+    if folded:
+        with open(folded, 'w') as out:
+            profiler.write_collapsed(out)
+
+
+if __name__ == "__main__":
+    main()
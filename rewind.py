@@ -0,0 +1,165 @@
+import sys
+import time
+import zlib
+from collections import deque
+import numpy as np
+from console import Console
+from savestate import snapshot, restore
+from scheduler import NTSC_FPS
+
+
+def _xor(a, b):
+    return np.bitwise_xor(np.frombuffer(a, dtype=np.uint8), np.frombuffer(b, dtype=np.uint8)).tobytes()
+
+
+class Rewind:
+    '''
+    history of save states, one every `every` frames, for about `seconds`
+    of play. Every `keyframe`th state is kept zlib compressed as it is,
+    the ones after it as the compressed xor with it, which is mostly zeros.
+    the oldest keyframe and its deltas are dropped together
+    '''
+
+    def __init__(self, console, every=4, keyframe=30, seconds=300, level=1):
+        self._console = console
+        self.every = every
+        self.keyframe = keyframe
+        self.level = level
+        self._capacity = int(seconds * NTSC_FPS)
+        # groups: [frame, compressed keyframe, [(frame, compressed delta)]]
+        self._groups = deque()
+        self._key = None # the newest keyframe, uncompressed
+        self.size = 0 # compressed bytes held
+
+    def clear(self):
+        self._groups.clear()
+        self._key = None
+        self.size = 0
+
+    def capture(self):
+        '''
+        call after every frame, keeps a state every `every` frames
+        '''
+        frame = self._console.frames
+        if frame % self.every:
+            return
+        groups = self._groups
+        if groups and frame <= self._last_frame():
+            return
+        state = snapshot(self._console)
+        if not groups or len(groups[-1][2]) + 1 >= self.keyframe:
+            blob = zlib.compress(state, self.level)
+            groups.append([frame, blob, []])
+            self._key = state
+        else:
+            if self._key is None:
+                self._key = zlib.decompress(groups[-1][1])
+            blob = zlib.compress(_xor(state, self._key), self.level)
+            groups[-1][2].append((frame, blob))
+        self.size += len(blob)
+        while len(groups) > 1 and frame - groups[1][0] >= self._capacity:
+            self._drop(groups.popleft())
+
+    def _last_frame(self):
+        group = self._groups[-1]
+        return group[2][-1][0] if group[2] else group[0]
+
+    def _drop(self, group):
+        self.size -= len(group[1]) + sum(len(blob) for _, blob in group[2])
+
+    def _state(self, group, i):
+        '''
+        the uncompressed state i of a group, -1 for its keyframe
+        '''
+        key = self._key if group is self._groups[-1] and self._key is not None else zlib.decompress(group[1])
+        if i < 0:
+            return key
+        return _xor(zlib.decompress(group[2][i][1]), key)
+
+    def _truncate(self, frame):
+        '''
+        forget the states from `frame` on
+        '''
+        groups = self._groups
+        while groups and groups[-1][0] >= frame:
+            self._drop(groups.pop())
+            self._key = None
+        if groups:
+            deltas = groups[-1][2]
+            while deltas and deltas[-1][0] >= frame:
+                self.size -= len(deltas.pop()[1])
+
+    def back(self):
+        '''
+        go back to the newest state before the current frame and forget the
+        ones after it. False when there is none
+        '''
+        self._truncate(self._console.frames)
+        if not self._groups:
+            return False
+        group = self._groups[-1]
+        restore(self._console, self._state(group, len(group[2]) - 1))
+        return True
+
+    def seek(self, frame):
+        '''
+        go to `frame`: restore the newest state at or before it and run the
+        frames in between. False when the history does not reach back there
+        '''
+        for group in reversed(self._groups):
+            if group[0] <= frame:
+                break
+        else:
+            return False
+        i = len(group[2]) - 1
+        while i >= 0 and group[2][i][0] > frame:
+            i -= 1
+        restore(self._console, self._state(group, i))
+        while self._console.frames < frame:
+            self._console.run_frame()
+        return True
+
+    def seconds(self):
+        '''
+        seconds of play in the history
+        '''
+        if not self._groups:
+            return 0
+        return (self._last_frame() - self._groups[0][0] + self.every) / NTSC_FPS
+
+    def bytes_per_minute(self):
+        seconds = self.seconds()
+        return self.size * 60 / seconds if seconds else 0
+
+
+def main():
+    '''
+    python rewind.py [rom] [frames] [every] [keyframe]
+
+    plays `frames` frames into a rewind history and reports its memory use
+    and the time to capture and to go back
+    '''
+    path = sys.argv[1] if len(sys.argv) > 1 else 'roms/mario.nes'
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 3600
+    every = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    keyframe = int(sys.argv[4]) if len(sys.argv) > 4 else 30
+    console = Console(path)
+    rewind = Rewind(console, every, keyframe)
+    captured = 0
+    for _ in range(frames):
+        console.run_frame()
+        start = time.perf_counter()
+        rewind.capture()
+        captured += time.perf_counter() - start
+    print('{}: {:.1f}s of history in {} bytes, {:.1f} KB per minute'.format(
+        path, rewind.seconds(), rewind.size, rewind.bytes_per_minute() / 1024))
+    print('capture    {:8.1f} us per frame'.format(captured / frames * 1e6))
+    steps = 0
+    start = time.perf_counter()
+    while steps < 100 and rewind.back():
+        steps += 1
+    print('back       {:8.1f} us per step'.format((time.perf_counter() - start) / max(steps, 1) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import sys
+import struct
+import time
+from console import Console
+
+
+MAGIC = b'NESSTATE'
+VERSION = 3
+
+# magic, version, crc32 of the PRG, frames run,
+# cpu: pc, a, x, y, p, sp, cycle, nmi pending,
+# ppu: dot, cycle, registers, read buffer, vram address, second write,
+# controller shift registers and strobe, size of the CHR RAM.
+# The Console.memories() follow as they are
+HEADER = struct.Struct('<8sHIQHBBBBBQ?IQ8sBI?BB?H')
+
+
+def snapshot(console):
+    '''
+    the whole machine state as bytes
+    '''
+    memories = console.memories()
+    chr_size = len(memories[4]) if len(memories) > 4 else 0
+    head = HEADER.pack(MAGIC, VERSION, console.rom_crc(), console.frames,
+                       *console.get_cpu().state(), *console.get_ppu().state(),
+                       *console.get_controller().state(), chr_size)
+    return b''.join([head] + memories)
+
+
+def restore(console, state):
+    '''
+    put the machine back into a snapshot() of the same rom. memories are
+    overwritten in place, views of them stay valid
+    '''
+    view = memoryview(state)
+    if len(view) < HEADER.size:
+        raise RuntimeError('Not a save state')
+    fields = HEADER.unpack_from(view)
+    if fields[0] != MAGIC:
+        raise RuntimeError('Not a save state')
+    if fields[1] != VERSION:
+        raise RuntimeError('Unsupported save state version: {}'.format(fields[1]))
+    if fields[2] != console.rom_crc():
+        raise RuntimeError('Save state of another rom')
+    memories = console.memories()
+    chr_size = len(memories[4]) if len(memories) > 4 else 0
+    if fields[-1] != chr_size or len(view) != HEADER.size + sum(len(mem) for mem in memories):
+        raise RuntimeError('Save state does not fit this console')
+
+    console.frames = fields[3]
+    console.get_cpu().set_state(fields[4:12])
+    console.get_ppu().set_state(fields[12:18])
+    console.get_controller().set_state(fields[18:21])
+    pos = HEADER.size
+    for mem in memories:
+        mem[:] = view[pos:pos + len(mem)]
+        pos += len(mem)
+    if chr_size:
+        console.get_ppu().get_tile_cache().invalidate(0, chr_size)
+
+
+def save(console, path):
+    with open(path, 'wb') as fout:
+        fout.write(snapshot(console))
+
+
+def load(console, path):
+    with open(path, 'rb') as fin:
+        restore(console, fin.read())
+
+
+def latency(func, repeat):
+    '''
+    best time of func() in seconds over `repeat` calls
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    '''
+    python savestate.py [rom] [frames] [repeat]
+
+    times snapshot and restore after `frames` frames of the rom
+    '''
+    path = sys.argv[1] if len(sys.argv) > 1 else 'roms/mario.nes'
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    console = Console(path)
+    for _ in range(frames):
+        console.run_frame()
+    state = snapshot(console)
+    print('{}: {} bytes'.format(path, len(state)))
+    print('{:<10} {:8.1f} us'.format('snapshot', latency(lambda: snapshot(console), repeat) * 1e6))
+    print('{:<10} {:8.1f} us'.format('restore', latency(lambda: restore(console, state), repeat) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import time
+
+
+# 1789773 Hz cpu clock, 29780.5 cycles per frame
+NTSC_FPS = 1789773 / 29780.5
+# frames per rendered frame in turbo mode
+TURBO_RENDER_EVERY = 10
+# time.sleep may overshoot by this much, the rest is spent spinning
+SPIN_TIME = 0.002
+
+
+def precise_sleep(seconds, clock=time.perf_counter):
+    end = clock() + seconds
+    if seconds > SPIN_TIME:
+        time.sleep(seconds - SPIN_TIME)
+    while clock() < end:
+        pass
+
+
+class FrameScheduler:
+    '''
+    paces whole emulated frames at `fps`. Deadlines are kept on an absolute
+    timeline so sleep errors do not add up; when behind, frames are still
+    emulated but rendering is skipped, at most `max_skip` in a row.
+    in turbo mode there is no pacing and only every `turbo_render`th frame is
+    rendered (none if 0)
+    '''
+
+    def __init__(self, fps=NTSC_FPS, max_skip=4, clock=time.perf_counter):
+        self.period = 1 / fps
+        self.frame_ms = 1000 / fps
+        self.max_skip = max_skip
+        self._clock = clock
+        self._next = None
+        self._skip_run = 0
+        self.turbo = False
+        self.turbo_render = TURBO_RENDER_EVERY
+        self._ticks = 0
+        # frames emulated forward, see frame_emulated
+        self.emulated = 0
+        self.rendered = 0
+        self.skipped = 0
+
+    def set_turbo(self, on):
+        self.turbo = on
+        self.reset()
+
+    def tick(self):
+        '''
+        wait until the next frame is due. returns True if that frame should
+        be rendered, False if it should only be emulated to catch up
+        '''
+        self._ticks += 1
+        if self.turbo:
+            if self.turbo_render and self._ticks % self.turbo_render == 0:
+                self.rendered += 1
+                return True
+            self.skipped += 1
+            return False
+
+        now = self._clock()
+        if self._next is None:
+            self._next = now
+        elif now < self._next:
+            precise_sleep(self._next - now, self._clock)
+            now = self._clock()
+        self._next += self.period
+
+        behind = now - self._next
+        if behind > self.max_skip * self.period:
+            # too slow to catch up, drop the backlog instead of fast forwarding
+            self._next = now
+        if behind > 0 and self._skip_run < self.max_skip:
+            self._skip_run += 1
+            self.skipped += 1
+            return False
+        self._skip_run = 0
+        self.rendered += 1
+        return True
+
+    def frame_emulated(self):
+        '''
+        count a frame run forward; ticks spent paused or rewinding are not
+        '''
+        self.emulated += 1
+
+    def reset(self):
+        '''
+        restart the timeline, e.g. after a pause
+        '''
+        self._next = None
+        self._skip_run = 0
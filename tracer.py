@@ -0,0 +1,100 @@
+import sys
+from array import array
+
+
+# event categories, one bit each
+CPU_NMI = 1 << 0
+CPU_RTI = 1 << 1
+PPU_VBLANK_SET = 1 << 2
+PPU_VBLANK_CLEAR = 1 << 3
+PPU_NMI = 1 << 4
+PPU_CTRL = 1 << 5
+NAMETABLE_ATTR = 1 << 6
+ALL = (1 << 7) - 1
+
+FORMATS = {
+    CPU_NMI: 'NMI CALLED, addr={:04X}',
+    CPU_RTI: 'RTI CALLED, ADDR={:04X}',
+    PPU_VBLANK_SET: 'Set VBANK, status={:02X}',
+    PPU_VBLANK_CLEAR: 'UNSET VBANK, status={:02X}',
+    PPU_NMI: 'PPU request NMI, ctrl={:02X}',
+    PPU_CTRL: 'Cpu Write: CTRL = {}',
+    NAMETABLE_ATTR: 'NameTable Write: ${:04X} = {}',
+}
+
+
+class Tracer:
+    '''
+    ring buffer of (category, clock, a, b) records. Call sites check
+    `TRACE.mask & CATEGORY` before emit(), so a disabled category costs one
+    attribute load and one AND.
+    '''
+
+    def __init__(self, size=1 << 16):
+        assert size & (size - 1) == 0, 'size must be a power of two'
+        self.mask = 0
+        self._size = size
+        self._kind = array('B', bytes(size))
+        self._clock = array('q', bytes(8 * size))
+        self._a = array('q', bytes(8 * size))
+        self._b = array('q', bytes(8 * size))
+        self._pos = 0
+        self._count = 0
+        self._clock_func = lambda: 0
+
+    def enable(self, mask=ALL):
+        self.mask |= mask
+
+    def disable(self, mask=ALL):
+        self.mask &= ~mask
+
+    def set_clock(self, func):
+        '''
+        func() gives the timestamp stored with each record, e.g. the cpu cycle
+        '''
+        self._clock_func = func
+
+    def emit(self, kind, a=0, b=0):
+        pos = self._pos
+        self._kind[pos] = kind.bit_length() - 1
+        self._clock[pos] = self._clock_func()
+        self._a[pos] = a
+        self._b[pos] = b
+        self._pos = (pos + 1) & (self._size - 1)
+        self._count += 1
+
+    def clear(self):
+        self._pos = 0
+        self._count = 0
+
+    def records(self):
+        '''
+        (category, clock, a, b) from the oldest to the newest record kept
+        '''
+        n = min(self._count, self._size)
+        start = (self._pos - n) & (self._size - 1)
+        for i in range(n):
+            pos = (start + i) & (self._size - 1)
+            yield 1 << self._kind[pos], self._clock[pos], self._a[pos], self._b[pos]
+
+    def dump(self, out=None):
+        out = out or sys.stdout
+        dropped = self._count - min(self._count, self._size)
+        if dropped > 0:
+            out.write('... {} older events dropped\n'.format(dropped))
+        for kind, clock, a, b in self.records():
+            out.write('{:>12} {}\n'.format(clock, FORMATS[kind].format(a, b)))
+
+    def dump_on_crash(self):
+        '''
+        dump the buffer to stderr when an exception reaches the top level
+        '''
+        hook = sys.excepthook
+
+        def excepthook(*args):
+            self.dump(sys.stderr)
+            hook(*args)
+        sys.excepthook = excepthook
+
+
+TRACE = Tracer()
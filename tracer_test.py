@@ -0,0 +1,52 @@
+import sys
+from collections import Counter
+from console import Console
+from cpu import Engine
+from tracer import TRACE, CPU_NMI, CPU_RTI
+
+
+def interrupts(path, engine, frames, fuse=False):
+    '''
+    the NMI and RTI records traced running `frames` frames of a rom
+    '''
+    console = Console(path, engine)
+    console.get_cpu().fuse = fuse
+    TRACE.set_clock(console.get_cpu().cycle)
+    TRACE.clear()
+    TRACE.enable(CPU_NMI | CPU_RTI)
+    try:
+        for _ in range(frames):
+            console.run_frame()
+    finally:
+        TRACE.disable(CPU_NMI | CPU_RTI)
+    return list(TRACE.records())
+
+
+def main():
+    '''
+    python tracer_test.py [rom] [frames]
+
+    every engine must trace an RTI for each NMI, at the same cycles as the
+    interpreter; a frame may end inside the NMI handler, so one NMI may
+    still be open
+    '''
+    path = sys.argv[1] if len(sys.argv) > 1 else 'roms/tank.nes'
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+    failed = 0
+    expected = None
+    for engine in Engine:
+        for fuse in (False, True):
+            records = interrupts(path, engine, frames, fuse)
+            counts = Counter(kind for kind, _, _, _ in records)
+            nmi, rti = counts[CPU_NMI], counts[CPU_RTI]
+            ok = nmi > 0 and rti in (nmi, nmi - 1) and expected in (None, records)
+            expected = expected or records
+            print('{:<12} fuse={:<5} {} NMI {} RTI {}'.format(
+                engine.name, str(fuse), nmi, rti, 'ok' if ok else 'FAILED'))
+            failed += not ok
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
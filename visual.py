@@ -1,60 +1,62 @@
 from entity import Entity
 from info_disp import FpsInfo
-from bus import Bus
-from cpu import Cpu6502
-from nes import Nes
-from ppu import Ppu
-from chip import *
+from chip import (BUTTON_A, BUTTON_B, BUTTON_SELECT, BUTTON_START,
+                  BUTTON_UP, BUTTON_DOWN, BUTTON_LEFT, BUTTON_RIGHT)
+from console import Console
+from cpu import Engine
+from ppu import to_rgb
 from palettes import PALETTES
 from game import Game
+from movie import MovieRecorder
+from rewind import Rewind
+from scheduler import FrameScheduler
+from tracer import TRACE
 import pygame
 
 
+# keyboard keys of the controller 1 buttons
+KEYS = (
+    (pygame.locals.K_x, BUTTON_A),
+    (pygame.locals.K_z, BUTTON_B),
+    (pygame.locals.K_RSHIFT, BUTTON_SELECT),
+    (pygame.locals.K_RETURN, BUTTON_START),
+    (pygame.locals.K_UP, BUTTON_UP),
+    (pygame.locals.K_DOWN, BUTTON_DOWN),
+    (pygame.locals.K_LEFT, BUTTON_LEFT),
+    (pygame.locals.K_RIGHT, BUTTON_RIGHT),
+)
+
+MOVIE_PATH = 'record.movie'
+
+
+def to_surface(indices):
+    '''
+    pygame surface of an array of nes colors
+    '''
+    height, width = indices.shape
+    return pygame.image.fromstring(to_rgb(indices).tobytes(), (width, height), 'RGB')
+
+
 class Machine(Entity):
 
-    def __init__(self):
+    def __init__(self, scheduler=None):
         super().__init__()
-        nes = Nes()
-        nes.load('roms/mario.nes')
-
-        # configure ppu
-        self._ppu_bus = Bus()
-        self._ppu_pattern = PatternTable()
-        self._ppu_pattern.load(nes.chr)
-        self._ppu_name = NameTable()
-        self._ppu_palette = PaletteTable()
-        self._ppu_bus.connect(self._ppu_pattern)
-        self._ppu_bus.connect(self._ppu_name)
-        self._ppu_bus.connect(self._ppu_palette)
-        self._ppu = Ppu(self._ppu_bus)
-
-        # configure cpu
-        self._cpu_ram = Ram()
-        self._pgr = PGRRom()
-        self._pgr.load(nes.pgr)
-        self._papu_ram = PAuExp()
-        self._cpu_bus = Bus()
-        self._cpu_bus.connect(self._pgr)
-        self._cpu_bus.connect(self._cpu_ram)
-        self._cpu_bus.connect(self._papu_ram)
-        self._cpu_bus.connect(self._ppu.get_register())
-        self._cpu = Cpu6502(self._cpu_bus)
-        self._cpu.reset()
-        
-        self._ppu.set_request_nmi(self._cpu.request_nmi)
+        self._scheduler = scheduler
+        self._console = Console('roms/mario.nes', Engine.Dispatch, verbose=True)
+        self._cpu = self._console.get_cpu()
+        self._ppu = self._console.get_ppu()
+        TRACE.set_clock(self._cpu.cycle)
 
         self._addr_map, self._code = self._cpu.decode(0x8000, 0xFF00)
         self._font = pygame.font.SysFont('inconsolatan', 24)
         self._cpu_running = False
-        self._cpu_time_last = 0
+        self._rewind = Rewind(self._console)
+        self._rewinding = False # while the rewind key is held
+        self._recorder = None
 
     def step(self):
-        run_cycles = self._cpu.run()
-        for _ in range(run_cycles):
-            self._ppu.run()
-            self._ppu.run()
-            self._ppu.run()
-        return 601 * run_cycles * 50
+        run_cycles, _ = self._cpu.run_cycles(1)
+        return run_cycles
 
     def draw_code(self, screen):
         log = self._cpu.log()
@@ -109,35 +111,69 @@ class Machine(Entity):
         screen.blit(reg_y, (reg_x_start + one_width, reg_y_start + one_height))
 
     def draw_ppu(self, screen):
-        img = self._ppu.get_background(0)
+        img = to_surface(self._ppu.background_indices(0))
         screen.blit(img, (0, 0))
-        img = self._ppu.get_background(1)
+        img = to_surface(self._ppu.background_indices(1))
         screen.blit(img, (256, 0))
-        img = self._ppu.get_background(2)
+        img = to_surface(self._ppu.background_indices(2))
         screen.blit(img, (0, 240))
-        img = self._ppu.get_background(3)
+        img = to_surface(self._ppu.background_indices(3))
         screen.blit(img, (256, 240))
 
     def draw_pattern(self, screen):
-        img = self._ppu.get_pattern_image()
+        img = to_surface(self._ppu.pattern_indices())
         width = int(256 * 1.125)
         height = int(128 * 1.125)
         img = pygame.transform.scale(img, (width, height))
         screen.blit(img, (800 - width, 600 - height))
 
     def draw_palettes(self, screen):
-        img = self._ppu.get_palettes_image()
+        img = to_surface(self._ppu.palette_indices())
         img = pygame.transform.scale(img, (128, 64))
         screen.blit(img, (0, 600 - 64))
 
+    def draw_rewind(self, screen):
+        info = 'Rewind: {:.0f}s, {:.0f} KB/min'.format(
+            self._rewind.seconds(), self._rewind.bytes_per_minute() / 1024)
+        color = (255, 0, 0) if self._rewinding else (0, 0, 0)
+        screen.blit(self._font.render(info, True, color), (550, 430))
+
     def on_update(self, delta):
-        cnt = 0
-        if self._cpu_running:
-            self._cpu_time_last += delta * 1000000
-            while self._cpu_time_last > 0:
-                self._cpu_time_last -= self.step()
-                cnt += 1
-        # print('Times: {}, Cycles: {}'.format(delta, cnt))
+        '''
+        the scheduler calls this once per frame
+        '''
+        if self._rewinding:
+            self._rewind.back()
+        elif self._cpu_running:
+            buttons = self.buttons()
+            if self._recorder is not None:
+                self._recorder.frame(buttons)
+            else:
+                self._console.get_controller().buttons[0] = buttons
+                self._console.run_frame()
+            self._rewind.capture()
+            if self._scheduler is not None:
+                self._scheduler.frame_emulated()
+
+    def buttons(self):
+        pressed = pygame.key.get_pressed()
+        res = 0
+        for key, button in KEYS:
+            if pressed[key]:
+                res |= button
+        return res
+
+    def toggle_recording(self):
+        '''
+        start recording a movie from the current state, or save it to
+        MOVIE_PATH
+        '''
+        if self._recorder is None:
+            self._recorder = MovieRecorder(self._console, from_state=True)
+        else:
+            self._recorder.save(MOVIE_PATH)
+            print('{} frames saved to {}'.format(len(self._recorder.movie), MOVIE_PATH))
+            self._recorder = None
 
     def on_render(self, screen):
         screen.fill(PALETTES[0])
@@ -147,6 +183,7 @@ class Machine(Entity):
         self.draw_ppu(screen)
         self.draw_pattern(screen)
         self.draw_palettes(screen)
+        self.draw_rewind(screen)
         # print(self._ppu.get_register().ctrl)
         # print(self._ppu.get_register().status)
 
@@ -154,19 +191,33 @@ class Machine(Entity):
         if event.type == pygame.locals.KEYDOWN:
             if event.key == pygame.locals.K_s:
                 self._cpu_running = not self._cpu_running
-                self._cpu_time_last = 0
             elif event.key == pygame.locals.K_r:
-                self._cpu.reset()
-                self._cpu_time_last = 0
+                self._console.reset()
+                self._rewind.clear()
+            elif event.key == pygame.locals.K_BACKSPACE:
+                self._rewinding = True
             elif event.key == pygame.locals.K_SPACE:
                 if not self._cpu_running:
                     self.step()
+            elif event.key == pygame.locals.K_t:
+                if self._scheduler is not None:
+                    self._scheduler.set_turbo(not self._scheduler.turbo)
+            elif event.key == pygame.locals.K_d:
+                TRACE.dump()
+            elif event.key == pygame.locals.K_m:
+                self.toggle_recording()
+        elif event.type == pygame.locals.KEYUP:
+            if event.key == pygame.locals.K_BACKSPACE:
+                self._rewinding = False
 
 
 def main():
-    game = Game(800, 600, "FCEMU")
-    fps = FpsInfo()
-    machine = Machine()
+    TRACE.enable()
+    TRACE.dump_on_crash()
+    scheduler = FrameScheduler()
+    game = Game(800, 600, "FCEMU", scheduler)
+    fps = FpsInfo(scheduler)
+    machine = Machine(scheduler)
     game.add_entity(machine)
     game.add_entity(fps)
     game.run()